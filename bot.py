@@ -1,24 +1,27 @@
 import os
 import asyncio
+import hmac
 import re
-import json
-from datetime import datetime, timedelta, timezone
+import time
+import unicodedata
 from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI, Request, HTTPException, Query, Response
-from fastapi.responses import JSONResponse
-from collections import deque
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
-from supabase import AsyncClient, create_async_client
+from fastapi.exceptions import RequestValidationError
+from collections import deque, defaultdict, OrderedDict
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, List, Dict, Any, Sequence
+from supabase import AsyncClient, AsyncClientOptions, create_async_client
 
 # Services
-from services.whatsapp import send_whatsapp_message, send_interactive_list, send_interactive_buttons, sanitize_argentina_number
+from services.whatsapp import send_whatsapp_message, send_interactive_list, send_interactive_buttons, sanitize_argentina_number, get_http_client, close_http_client
 import services.telegram_crm as telegram_crm
 
 # Environment Variables
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 VERIFY_TOKEN = os.environ.get("VERIFY_TOKEN")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") # unset -> /metrics is disabled
 
 # Initialize Supabase Client
 supabase: AsyncClient = None
@@ -36,39 +39,136 @@ WELCOME_TEXT = (
 
 SHORT_WELCOME = "✅ Listo. Escribí el modelo (ej: *Gol 1.6* o *Hilux 2015*) para buscar."
 
+SEARCH_TIP = "💡 Tip: escribí marca o modelo para buscar (ej: *Gol 1.6* o *Hilux 2015*)."
+SEARCH_TOO_LONG = "✂️ Mensaje muy largo. Resumí tu búsqueda a marca, modelo y año (ej: *Gol 1.6 2012*)."
+
+# Longer texts are never a vehicle query: no parse, no search, no mirror
+MAX_SEARCH_TEXT_LEN = 200
+
+# Whole-message keywords (matched against the lowercased text)
+HUMAN_EXIT_KEYWORDS = frozenset({'menu', 'start', 'bot', 'volver', 'inicio'})
+CANCEL_KEYWORDS = frozenset({'cancelar', 'salir', 'menu', 'basta', 'chau', 'volver'})
+GREETING_KEYWORDS = frozenset({'hola', 'start', 'hi', 'hello', 'menú', 'menu'})
+
+# Survey answers (button title or free text), matched anywhere in the message
+SPEED_PRIORITY_RE = re.compile(r'velocidad|rocket', re.IGNORECASE)
+SHIPPING_RE = re.compile(r'env[ií]os', re.IGNORECASE)
+URGENT_RE = re.compile(r'ya|fuego|🔥', re.IGNORECASE)
+
+# Static button payloads (read-only, shared by every request)
+BTN_SEARCH_OTHER = {"id": "btn_search_error", "title": "🔍 Buscar otro"}
+BTNS_SEARCH_OTHER = (BTN_SEARCH_OTHER,)
+BTNS_SEARCH_PART = ({"id": "btn_search_error", "title": "🔍 Buscar repuesto"},)
+BTN_CANCEL_SURVEY = {"id": "btn_cancel_survey", "title": "🔙 Cancelar"}
+BTNS_CANCEL_SURVEY = (BTN_CANCEL_SURVEY,)
+BTNS_RETURN_BOT = ({"id": "btn_return_bot", "title": "🤖 Volver al Bot"},)
+BTNS_MECH_PRIORITY = (
+    {"id": "btn_prio_speed", "title": "🚀 Velocidad"},
+    {"id": "btn_prio_price", "title": "💰 Precio"},
+    BTN_CANCEL_SURVEY,
+)
+BTNS_LOGISTICS = (
+    {"id": "btn_logistics_ship", "title": "📦 Hago Envíos"},
+    {"id": "btn_logistics_pickup", "title": "🏪 Solo Retiro"},
+    BTN_CANCEL_SURVEY,
+)
+BTNS_URGENCY = (
+    {"id": "btn_urgency_high", "title": "🔥 Lo necesito YA"},
+    {"id": "btn_urgency_normal", "title": "💰 Busco Precio"},
+    BTN_CANCEL_SURVEY,
+)
+
 # Cache processed message IDs to prevent retry loops
+# (deque = FIFO eviction order, set = O(1) membership; always updated together)
 PROCESSED_MSG_IDS = deque(maxlen=1000)
-
-# --- Lifespan for Telegram Polling ---
+PROCESSED_MSG_SET = set()
+
+def seen_message(msg_id: str) -> bool:
+    """Returns True if msg_id was already processed, otherwise records it."""
+    if msg_id in PROCESSED_MSG_SET:
+        return True
+    if len(PROCESSED_MSG_IDS) == PROCESSED_MSG_IDS.maxlen:
+        PROCESSED_MSG_SET.discard(PROCESSED_MSG_IDS[0])
+    PROCESSED_MSG_IDS.append(msg_id)
+    PROCESSED_MSG_SET.add(msg_id)
+    return False
+
+# Bounds concurrent message processing (DB connections / API calls) under bursts
+PROCESSING_SEMAPHORE = asyncio.Semaphore(40)
+
+# Messages are processed after the webhook acks; a per-phone lock keeps each
+# user's messages in arrival order. Locks are dropped once a phone goes idle.
+PHONE_LOCKS: Dict[str, asyncio.Lock] = {}
+PHONE_INFLIGHT: Dict[str, int] = defaultdict(int)
+
+# Telegram mirror queue: bot replies and 'log' admin events are coalesced per
+# phone into one admin message
+MIRROR_Q: asyncio.Queue = asyncio.Queue()
+MIRROR_WINDOW_S = 0.2
+MIRROR_MAX_CHARS = 4000 # Telegram caps messages at 4096 chars
+
+# Analytics rows are buffered and written to 'logs' in bulk inserts
+LOG_BUFFER: deque = deque()
+LOG_FLUSH_INTERVAL_S = 2.0
+LOG_BATCH_SIZE = 100
+
+# Strong refs for fire-and-forget tasks (the event loop only keeps weak refs)
+BACKGROUND_TASKS = set()
+
+def spawn(coro):
+    """Schedules a coroutine off the response path; errors are logged, not raised."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+def _on_background_done(task: asyncio.Task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"[Background Error] {task.exception()}")
+
+# --- Lifespan ---
+# Telegram polling runs in its own process (worker_telegram.py) so aiogram's
+# long-poll never competes with webhook handlers on this event loop.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    print("Starting Telegram Bot Polling...")
-    
     # Init Supabase
     global supabase
     if SUPABASE_URL and SUPABASE_KEY:
-        supabase = await create_async_client(SUPABASE_URL, SUPABASE_KEY)
+        # Same keep-alive pool as the Graph API sends (one client per process)
+        supabase = await create_async_client(
+            SUPABASE_URL, SUPABASE_KEY,
+            options=AsyncClientOptions(httpx_client=get_http_client())
+        )
     
-    bot, dp = await telegram_crm.start_telegram()
-    # Share Supabase client with services
+    # Share Supabase client with services (used for topic lookups when mirroring)
     telegram_crm.supabase = supabase
 
-    
-    # Run polling in background
-    # We use asyncio.create_task to run it without blocking FastAPI
-    polling_task = asyncio.create_task(dp.start_polling(bot))
-    
+    # Warm the brand index before the first brand-only query
+    refresh_brand_models()
+
+    mirror_task = asyncio.create_task(_mirror_flusher())
+    log_task = asyncio.create_task(_log_flusher())
+
     yield
     
     # Shutdown
-    print("Stopping Telegram Bot Polling...")
-    await bot.session.close()
-    polling_task.cancel()
-    try:
-        await polling_task
-    except asyncio.CancelledError:
-        pass
+    # Let messages already acked to Meta finish before tearing down clients
+    if BACKGROUND_TASKS:
+        await asyncio.wait(BACKGROUND_TASKS, timeout=10)
+    for task in (mirror_task, log_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await _drain_mirror_queue()
+    await _flush_log_buffer()
+    await close_http_client()
+
+    if telegram_crm.bot_instance:
+        await telegram_crm.bot_instance.session.close()
 
 # Initialize FastAPI
 app = FastAPI(lifespan=lifespan)
@@ -77,40 +177,82 @@ app = FastAPI(lifespan=lifespan)
 async def log_to_db(phone: str, action_type: str, content: str, payload: Optional[Dict] = None):
     """
     Unified logging function for analytics.
-    Maps everything to the strict 'logs' table schema.
+    Maps everything to the strict 'logs' table schema. Rows are buffered and
+    bulk-inserted by _log_flusher, so this never waits on the database.
     """
     if not supabase: return
+    LOG_BUFFER.append({
+        "phone_number": phone, 
+        "action_type": action_type, 
+        "content": content[:200] if content else "", # Truncate for safety
+        "raw_message": payload if payload else None,
+        "direction": "analytics",
+        "status": "saved"
+    })
+    if len(LOG_BUFFER) >= LOG_BATCH_SIZE:
+        spawn(_flush_log_buffer())
+
+async def _flush_log_buffer():
+    """Writes every buffered analytics row in one INSERT."""
+    if not supabase or not LOG_BUFFER: return
+    batch = list(LOG_BUFFER)
+    LOG_BUFFER.clear()
     try:
-        data = {
-            "phone_number": phone, 
-            "action_type": action_type, 
-            "content": content[:200] if content else "", # Truncate for safety
-            "raw_message": payload if payload else None,
-            "direction": "analytics",
-            "status": "saved"
-        }
-        await supabase.table("logs").insert(data).execute()
+        await supabase.table("logs").insert(batch).execute()
     except Exception as e:
-        print(f"[Analytics Error] {e}")
+        print(f"[Analytics Error] {len(batch)} rows dropped: {e}")
+
+async def _log_flusher():
+    """Background task: flushes LOG_BUFFER every LOG_FLUSH_INTERVAL_S."""
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL_S)
+        await _flush_log_buffer()
 
 async def log_user_event(phone: str, action: str, details: str):
     """Wrapper for backward compatibility."""
     await log_to_db(phone, action, details)
 
-async def update_user_metadata(phone: str, updates: dict):
-    if not supabase: return
-    try:
-        res = await supabase.table("users").select("metadata").eq("phone", phone).maybe_single().execute()
-        current = res.data.get("metadata") or {}
-        # Ensure dict
-        if isinstance(current, str):
-             try: current = json.loads(current)
-             except: current = {}
-        
-        current.update(updates)
-        await supabase.table("users").update({"metadata": current}).eq("phone", phone).execute()
-    except Exception as e:
-        print(f"[Metadata Error] {e}")
+async def update_user_fields(phone: str, fields: dict):
+    """
+    Single entry point for users column updates (status, name, location, ...).
+    Returns the updated row (PostgREST returns the representation), so callers
+    never need a follow-up SELECT.
+    """
+    if not supabase: return None
+    res = await supabase.table("users").update(fields).eq("phone", phone).execute()
+    return res.data[0] if res and res.data else None
+
+async def flush_user_fields(phone: str, pending: dict):
+    """
+    Writes the changes queued for this message in one UPDATE and clears them.
+    pending["metadata"] is a patch merged into users.metadata (see
+    queue_metadata), so it goes through the update_user RPC with the columns.
+    """
+    if not pending: return None
+    fields = dict(pending)
+    meta = fields.pop("metadata", None)
+    if meta is None:
+        row = await update_user_fields(phone, fields)
+    elif supabase:
+        res = await supabase.rpc("update_user", {"p_phone": phone, "p_fields": fields, "p_meta": meta}).execute()
+        row = res.data[0] if res and res.data else None
+    else:
+        row = None
+    pending.clear()
+    return row
+
+async def flush_and_retitle(phone: str, pending: dict, status: str, user_type: str):
+    """
+    Writes pending, then renames the Telegram topic from the returned row.
+    Handlers gather this with their reply: the reply doesn't depend on either
+    call, and the per-phone lock holds the next message until both finish.
+    """
+    user_row = await flush_user_fields(phone, pending)
+    await telegram_crm.update_topic_title(phone, status, user_type, user=user_row)
+
+def queue_metadata(pending: dict, updates: dict):
+    """Queues keys to merge into users.metadata with this message's UPDATE."""
+    pending.setdefault("metadata", {}).update(updates)
 
 def get_message_content(msg: dict) -> str:
     """Extract content from Text or Button Reply"""
@@ -126,17 +268,83 @@ def get_message_content(msg: dict) -> str:
             return msg['interactive']['list_reply']['title']
     return ""
 # --- Search Engine V2 ---
-STOP_WORDS = ['quiero', 'busco', 'necesito', 'para', 'el', 'la', 'un', 'una', 'auto', 'coche', 'camioneta', 'filtro', 'filtros', 'motor']
+STOP_WORDS = frozenset({'quiero', 'busco', 'necesito', 'para', 'el', 'la', 'un', 'una', 'auto', 'coche', 'camioneta', 'filtro', 'filtros', 'motor'})
 
 SYNONYMS = {
     'vw': 'volkswagen', 'volks': 'volkswagen',
     'chevy': 'chevrolet',
     'mb': 'mercedes-benz', 'mercedes': 'mercedes-benz',
-    'citroen': 'citroën',
-    's-10': 's10', 's 10': 's10'
+    'citroen': 'citroën'
 }
 
-NUMERIC_MODEL_WHITELIST = ['206', '207', '208', '306', '307', '308', '405', '408', '504', '505', '3008', '5008', '500', 'f100', 'f150', 'ram1500', 'ram2500']
+# Year ("2012") or displacement with optional liter suffix ("1.6", "2l", "2.0l")
+YEAR_DISP_RE = re.compile(r'(?P<year>\d{4})|(?P<disp>\d+(?:\.\d*)?|\.\d+)l?')
+
+# "S-10" / "S 10" span a token boundary, so they are folded before splitting
+S10_RE = re.compile(r'\bs[- ]?10\b')
+
+# Interactive button ids: btn_<action>[_<arg>] where arg is a vehicle id or free text
+BTN_ID_RE = re.compile(
+    r"^btn_(?P<action>add_missing|buy_loc|menu_mech|back_actions|human_help|return_bot"
+    r"|search_retry|search_error|is_mechanic|is_seller)(?:_(?P<arg>.*))?$",
+    re.DOTALL
+)
+
+# Decimal comma in displacements ("1,6" -> "1.6"), compiled once for the parser
+COMMA_DECIMAL_RE = re.compile(r'(\d+),(\d+)')
+
+# Punctuation dropped from search input in a single pass
+QUERY_STRIP_TABLE = str.maketrans('', '', ",()'")
+
+# Characters stripped from search tokens (LIKE wildcards, quotes, list syntax)
+TOKEN_STRIP_TABLE = str.maketrans('', '', "'%_*{},\"")
+
+# Collapses runs of whitespace in free-text survey answers (e.g. "San  Martín\n")
+WS_RE = re.compile(r"\s+")
+
+NUMERIC_MODEL_WHITELIST = frozenset({'206', '207', '208', '306', '307', '308', '405', '408', '504', '505', '3008', '5008', '500', 'f100', 'f150', 'ram1500', 'ram2500'})
+
+# search_vehicle result cache: key -> (monotonic ts, rows), LRU-evicted
+SEARCH_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+SEARCH_CACHE_TTL_S = 60
+SEARCH_CACHE_MAX = 512
+
+# Search result fuel badges, checked in priority order
+FUEL_BADGES = (
+    (re.compile(r'diesel'), "🛢️ Diesel"),
+    (re.compile(r'gnc|gas'), "🔥 GNC"),
+    (re.compile(r'nafta|benz'), "⛽"),
+)
+
+# Vehicle card sections: part_type -> heading, in display order
+PART_TYPE_LABELS = (
+    ('oil', '🛢️ Aceite'),
+    ('air', '💨 Aire'),
+    ('cabin', '❄️ Habitáculo'),
+    ('fuel', '⛽ Combustible'),
+)
+
+# Hit/miss counters for the caches above and below, exposed on /metrics
+CACHE_STATS: "defaultdict[str, int]" = defaultdict(int)
+
+# get_vehicle_card cache: vehicle_id -> (monotonic ts, row). The catalog only
+# changes on imports, so a 10 min TTL is safe.
+VEHICLE_CARD_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+VEHICLE_CARD_CACHE_TTL_S = 600
+VEHICLE_CARD_CACHE_MAX = 2048
+
+# Brand -> model picker index (sql/007): brand_key -> (brand_car, sorted models,
+# vehicle count). Reloaded whole in the background every BRAND_MODELS_TTL_S;
+# one row per brand, so it stays small.
+BRAND_MODELS: Dict[str, tuple] = {}
+BRAND_MODELS_LOADED_AT = float("-inf")
+BRAND_MODELS_TTL_S = 600
+
+# Column sets per code path (avoid select("*") payloads)
+VEHICLE_SEARCH_COLUMNS = "vehicle_id, brand_car, model, series_suffix, body_type, fuel_type, year_from, year_to, engine_disp_l, power_hp, engine_valves"
+VEHICLE_CARD_COLUMNS = "brand_car, model, year_from, year_to, engine_code, engine_series"
+# Card + its filters in one request (vehicle_part embedded via FK)
+VEHICLE_CARD_SELECT = f"{VEHICLE_CARD_COLUMNS}, vehicle_part(role, part(brand_filter, part_code, part_type))"
 
 def parse_search_query(text: str) -> dict:
     """
@@ -144,20 +352,21 @@ def parse_search_query(text: str) -> dict:
     Example: "Toyota Hilux 3.0 2010" -> year=2010, engine=3.0, tokens=['toyota', 'hilux']
     """
     if not text: return {}
-    
+    # Cached on the normalized text; callers get a fresh dict they may mutate
+    tokens, year, engine = _parse_search_query(text.strip().lower())
+    return {"text_tokens": list(tokens), "year_filter": year, "engine_filter": engine}
+
+@lru_cache(maxsize=1024)
+def _parse_search_query(text: str) -> tuple:
+    """Pure parser behind parse_search_query: (tokens, year_filter, engine_filter)."""
     # 1. Sanitize & Normalize
     # Pre-process: Converts "1,6" to "1.6" via regex so the sanitizer doesn't destroy it.
-    text_pre = re.sub(r'(\d+),(\d+)', r'\1.\2', text.lower())
+    text_pre = COMMA_DECIMAL_RE.sub(r'\1.\2', text.lower())
+    text_pre = S10_RE.sub('s10', text_pre)
     
     # Remove stand-alone input like " - " but verify if it acts as a separator
-    clean_text = text_pre.replace(',', '').replace('(', '').replace(')', '').replace("'", "")
+    clean_text = text_pre.translate(QUERY_STRIP_TABLE)
     
-    # Handle synonyms (Rough replace)
-    for k, v in SYNONYMS.items():
-        # Using simple replace might be dangerous for short words, but 'vw' -> 'volkswagen' is usually safe.
-        # Ideally token-based replacement, but this suffices for MVP.
-        clean_text = clean_text.replace(k, v)
-        
     tokens = clean_text.split()
     
     parsed = {
@@ -167,6 +376,9 @@ def parse_search_query(text: str) -> dict:
     }
     
     for token in tokens:
+        # Synonyms are whole-token only ('vw' must not touch 'volkswagen')
+        token = SYNONYMS.get(token, token)
+
         # A. Stop Words
         if token in STOP_WORDS:
             continue
@@ -176,150 +388,304 @@ def parse_search_query(text: str) -> dict:
             parsed["text_tokens"].append(token)
             continue
             
-        # C. Year Parser (1950-2030)
-        # Check if 4 digits
-        if token.isdigit() and len(token) == 4:
-            val = int(token)
-            if 1950 <= val <= 2030:
-                parsed["year_filter"] = val
+        # C/D. Year (1950-2030) or Displacement (1.6, 2.0, 2l, 2.0l): one regex match
+        m = YEAR_DISP_RE.fullmatch(token)
+        if m:
+            year, disp = m.group('year', 'disp')
+            if year and 1950 <= int(year) <= 2030:
+                parsed["year_filter"] = int(year)
+                continue
+            # Verify reasonable engine range (0.5 to 16.0); "2" / "2l" -> "2.0"
+            if disp and len(token) <= 5 and 0.5 <= float(disp) <= 16.0:
+                parsed["engine_filter"] = disp if '.' in disp else disp + ".0"
                 continue
-                
-        # D. Displacement Parser (1.6, 2.0, 2l, 2.0l etc)
-        # Regex-like check: digit + [.,] + digit OR digit + 'l'
-        # We handle "1.6", "2,0", "2l", "2.0l"
-        token_lower = token.lower()
-        if len(token) <= 5: # Small enough
-             # Strip 'l' if present at end
-             is_liter = False
-             if token_lower.endswith('l'):
-                 token_clean = token_lower[:-1]
-                 is_liter = True
-             else:
-                 token_clean = token_lower
-
-             # Check format
-             if any(c in token_clean for c in ['.', ',']) or is_liter or token_clean.isdigit():
-                 try:
-                     norm = token_clean.replace(',', '.')
-                     # Check if float
-                     val_float = float(norm)
-                     
-                     # If it was just an integer "2" or "2l", make it "2.0"
-                     # Logic: if no dot in norm, append .0
-                     if '.' not in norm:
-                         norm += ".0"
-                     
-                     # Verify reasonable engine range (0.5 to 16.0)
-                     if 0.5 <= val_float <= 16.0:
-                         parsed["engine_filter"] = norm
-                         continue
-                 except:
-                     pass
                 
         # E. Fallback: Text Token
         parsed["text_tokens"].append(token)
         
-    return parsed
-
-def to_accent_regex(text: str) -> str:
+    return tuple(parsed["text_tokens"]), parsed["year_filter"], parsed["engine_filter"]
+
+# Letters f_unaccent (sql/001) folds that have no NFKD decomposition
+ACCENT_FOLD_EXTRA = {'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ß': 'ss', 'ł': 'l', 'đ': 'd', 'ð': 'd', 'þ': 'th', 'ħ': 'h', 'ŧ': 't', 'ı': 'i'}
+
+# Latin letters -> base letters (á->a, ñ->n, ø->o, ß->ss), built once at import from
+# NFKD over Latin-1, Latin Extended-A/B and Latin Extended Additional (ạ, ế, ỳ)
+ACCENT_FOLD_TABLE = str.maketrans({
+    **{
+        c: "".join(ch for ch in unicodedata.normalize("NFKD", c) if not unicodedata.combining(ch))
+        for c in map(chr, (*range(0xC0, 0x250), *range(0x1E00, 0x1F00)))
+        if unicodedata.normalize("NFKD", c) != c
+    },
+    **ACCENT_FOLD_EXTRA,
+})
+
+def fold_accents(text: str) -> str:
     """
-    Converts text to accent-insensitive regex pattern.
-    Example: "mio" -> "m[ií]o"
+    Lowercases and strips accents to match vehicle.search_text (lower(unaccent(...))).
+    Example: "Mégane" -> "megane"
     """
-    mapping = {
-        'a': '[aá]', 'e': '[eé]', 'i': '[ií]', 'o': '[oó]', 'u': '[uúü]', 
-        'n': '[nñ]'
-    }
-    return "".join([mapping.get(c, c) for c in text])
+    return text.lower().translate(ACCENT_FOLD_TABLE)
 
 async def search_vehicle(query_data: dict, limit: int = 12):
     """
     Executes the dynamic Supabase query.
+    Results are cached in-process for SEARCH_CACHE_TTL_S (popular models repeat).
     """
     if not supabase: return []
+
+    cache_key = (
+        query_data.get("year_filter"),
+        query_data.get("engine_filter"),
+        tuple(sorted(query_data.get("text_tokens", []))),
+        limit
+    )
+    hit = SEARCH_CACHE.get(cache_key)
+    if hit and time.monotonic() - hit[0] < SEARCH_CACHE_TTL_S:
+        CACHE_STATS["search_hit"] += 1
+        SEARCH_CACHE.move_to_end(cache_key)
+        return list(hit[1])
+    CACHE_STATS["search_miss"] += 1
     
-    query = supabase.table("vehicle").select("vehicle_id, brand_car, model, series_suffix, body_type, fuel_type, year_from, year_to, engine_disp_l, power_hp, engine_valves")
-    
-    # 1. Technical Filters
-    if query_data.get("year_filter"):
-        y = query_data["year_filter"]
-        # Logic: (year_from <= y AND (year_to >= y OR year_to IS NULL)) OR model ilike %y%
-        # We construct a raw OR filter for the entire year logic block
-        # Supabase syntax: "and(year_from.lte.y,or(year_to.gte.y,year_to.is.null)),model.ilike.%y%"
-        # Actually, to combine complex AND/OR groups in PostgREST is tricky with the py wrapper's simple methods.
-        # But we can use the `or_` method on the top level with the raw string syntax.
-        # The condition we want is: condition_year_range OR condition_model_name
-        
-        # condition_year_range = and(year_from.lte.Y,or(year_to.gte.Y,year_to.is.null))
-        # condition_model_name = model.ilike.*Y*
-        
-        raw_filter = f"and(year_from.lte.{y},or(year_to.gte.{y},year_to.is.null)),model.ilike.*{y}*"
-        query = query.or_(raw_filter)
-        
-    if query_data.get("engine_filter"):
-        # Assuming engine_disp_l is the column. 
-        # Note: input might be "1.6" text, db might be numeric 1.6. 
-        # .eq() usually handles auto-casting if flexible.
-        query = query.eq('engine_disp_l', query_data["engine_filter"])
+    # Text Search Everywhere, every token must match:
+    # - long tokens: substring of search_text, a generated lowercased + unaccented
+    #   concat of brand, model, suffix, engine code/series, body, fuel and valves
+    #   with a trigram GIN index (sql/001_vehicle_search_text.sql).
+    #   Example: "megane" -> matches "Megane", "Mégane"
+    # - short tokens: whole word of its tsvector twin search_doc
+    #   (sql/003_vehicle_search_doc.sql).
+    #   Example: "mio" -> matches "Clio Mío" but NOT "Kamion"
+    long_tokens, short_tokens = [], []
+    for token in query_data.get("text_tokens", []):
+        # Sanitize token (LIKE wildcards, quotes)
+        safe_token = fold_accents(token.translate(TOKEN_STRIP_TABLE))
+        if not safe_token:
+            continue
+        (long_tokens if len(safe_token) > 3 else short_tokens).append(safe_token)
+
+    # One RPC runs the whole filter server-side (sql/005_search_vehicles.sql):
+    # year = in production range OR part of the model name; engine = exact displacement
+    query = supabase.rpc("search_vehicles", {
+        "p_long": long_tokens,
+        "p_short": " ".join(short_tokens) or None,
+        "p_year": query_data.get("year_filter"),
+        "p_engine": query_data.get("engine_filter"),
+        "p_limit": limit
+    }).select(VEHICLE_SEARCH_COLUMNS)
         
-    # 2. Text Search Everywhere
-    # For EACH token, it must match AT LEAST ONE of the target columns (.or_ logic per token)
-    # But we want AND logic between tokens (Toyota AND Hilux).
-    # So we chain .or_() filters for each token? 
-    # Wait. Supabase .or_() applies to the whole query scope if not careful.
-    # To do (ColA ilike %T1% OR ColB ilike %T1%) AND (ColA ilike %T2% OR ColB ilike %T2%):
-    # We just chain multiple .or_() clauses. Supabase treats chained filters as AND.
-    
-    target_cols = [
-        "brand_car", "model", "series_suffix", 
-        "engine_code", "engine_series", 
-        "body_type", "fuel_type", "engine_valves"
+    res = await query.execute()
+    rows = res.data
+
+    # Nothing exact: retry the long tokens with trigram word similarity so
+    # typos ("amarock", "corola") still land (sql/008_search_vehicles_fuzzy.sql).
+    # Short tokens keep their exact whole-word filter: "fiat 500" must not
+    # fall back to every Fiat.
+    if not rows and long_tokens:
+        res = await supabase.rpc("search_vehicles_fuzzy", {
+            "p_long": long_tokens,
+            "p_short": " ".join(short_tokens) or None,
+            "p_year": query_data.get("year_filter"),
+            "p_engine": query_data.get("engine_filter"),
+            "p_limit": limit
+        }).select(VEHICLE_SEARCH_COLUMNS).execute()
+        rows = res.data
+
+    SEARCH_CACHE[cache_key] = (time.monotonic(), rows)
+    SEARCH_CACHE.move_to_end(cache_key)
+    if len(SEARCH_CACHE) > SEARCH_CACHE_MAX:
+        SEARCH_CACHE.popitem(last=False)
+    return list(rows)
+
+def render_vehicle_card(vehicle: dict) -> str:
+    """
+    Builds the WhatsApp card text for a VEHICLE_CARD_SELECT row: title, filters
+    grouped by PART_TYPE_LABELS, and the engine footer.
+    """
+    display_title = f"{vehicle.get('brand_car')} {vehicle.get('model')}"
+
+    # VEHICLE_CARD_SELECT always returns these part columns: index directly
+    found_parts = defaultdict(list)
+    for item in vehicle.get('vehicle_part') or []:
+        part = item['part']
+        if part:
+            found_parts[part['part_type'].lower()].append(f"• {part['brand_filter']}: {part['part_code'].replace('*', '')}")
+
+    sections = [f"{label}\n" + "\n".join(found_parts[k]) + "\n\n"
+                for k, label in PART_TYPE_LABELS if k in found_parts]
+    msg_body = f"🚗 **{display_title}**\n\n" + ("".join(sections) if found_parts else "⚠️ Sin filtros cargados.\n")
+
+    # Add Mechanic/Pro Tech Info (Engine Series/Code)
+    # UX: Subtle footer
+    tech_info = " | ".join(f"{label}: {val}" for label, val in (
+        ("Serie", vehicle.get('engine_series')),
+        ("Motor", vehicle.get('engine_code')),
+    ) if val)
+    if tech_info:
+        msg_body += f"\n🔧 {tech_info}"
+
+    return msg_body
+
+async def get_vehicle_card(vehicle_id: str) -> Optional[dict]:
+    """
+    Returns the vehicle card row (VEHICLE_CARD_SELECT, parts embedded) plus
+    card_text, its rendered message, served from VEHICLE_CARD_CACHE when fresh.
+    Missing vehicles are not cached.
+    """
+    hit = VEHICLE_CARD_CACHE.get(vehicle_id)
+    if hit and time.monotonic() - hit[0] < VEHICLE_CARD_CACHE_TTL_S:
+        CACHE_STATS["card_hit"] += 1
+        VEHICLE_CARD_CACHE.move_to_end(vehicle_id)
+        return hit[1]
+    if not supabase: return None
+    CACHE_STATS["card_miss"] += 1
+
+    res = await supabase.table("vehicle").select(VEHICLE_CARD_SELECT).eq("vehicle_id", vehicle_id).maybe_single().execute()
+    vehicle = res.data if res else None
+    if vehicle:
+        vehicle['card_text'] = render_vehicle_card(vehicle)
+        VEHICLE_CARD_CACHE[vehicle_id] = (time.monotonic(), vehicle)
+        VEHICLE_CARD_CACHE.move_to_end(vehicle_id)
+        if len(VEHICLE_CARD_CACHE) > VEHICLE_CARD_CACHE_MAX:
+            VEHICLE_CARD_CACHE.popitem(last=False)
+    return vehicle
+
+def refresh_brand_models():
+    """Schedules a background reload of BRAND_MODELS once it is older than the TTL."""
+    global BRAND_MODELS_LOADED_AT
+    if supabase and time.monotonic() - BRAND_MODELS_LOADED_AT > BRAND_MODELS_TTL_S:
+        # Stamp first: one reload in flight at a time, and a failed load is
+        # retried after the TTL instead of on every message
+        BRAND_MODELS_LOADED_AT = time.monotonic()
+        spawn(_load_brand_models())
+
+async def _load_brand_models():
+    """Replaces BRAND_MODELS from the vehicle_brand_models RPC (sql/007)."""
+    global BRAND_MODELS
+    try:
+        res = await supabase.rpc("vehicle_brand_models", {}).execute()
+        BRAND_MODELS = {
+            r['brand_key']: (r['brand_car'], tuple(sorted(r['models'] or ())), r['vehicle_count'])
+            for r in res.data or []
+        }
+    except Exception as e:
+        print(f"Brand Index Error: {e}")
+
+def get_brand_models(brand_key: str) -> Optional[tuple]:
+    """
+    Looks up (brand_car, models, vehicle_count) for a folded brand name in
+    BRAND_MODELS. A stale index keeps serving while it reloads in the background.
+    """
+    refresh_brand_models()
+    return BRAND_MODELS.get(brand_key)
+
+def vehicle_list_row(v: dict) -> dict:
+    """
+    Builds the WhatsApp list row for one search hit.
+    Title: Engine + HP + Valves + Fuel. Description: Brand Model Suffix • Year.
+    """
+    get = v.get
+    # 1. Fuel Badge Logic (first matching group wins: diesel > gnc > nafta)
+    f_raw = (get('fuel_type') or '').lower()
+    fuel_badge = next((badge for rx, badge in FUEL_BADGES if rx.search(f_raw)), "")
+
+    # 2. Build Title (Engine + HP + Valves + Fuel)
+    title_parts = []
+    if get('engine_disp_l'): 
+        title_parts.append(f"{v['engine_disp_l']}L")
+    if get('power_hp'): 
+        title_parts.append(f"{v['power_hp']}CV")
+    if get('engine_valves'):
+        title_parts.append(str(v['engine_valves']))
+    
+    # Append Fuel priority (after engine specs)
+    if fuel_badge:
+        title_parts.append(fuel_badge)
+
+    title_str = " ".join(title_parts) 
+    if not title_str.strip():
+        title_str = "Ver Detalles" # Fallback
+    
+    # 3. Description (Brand Model Suffix • Year)
+    # Body type explicitly excluded per requirements
+    y_to = str(v['year_to']) if get('year_to') else 'Pres'
+    year_str = f"{get('year_from')}-{y_to}" if get('year_from') else ""
+    
+    # Merge Model + Suffix
+    model_full = get('model', '')
+    if get('series_suffix'):
+        model_full += f" {v['series_suffix']}"
+    
+    desc_parts = [
+        get('brand_car'), 
+        model_full,
+        year_str
     ]
+    # Filter empty and join
+    full_desc = " • ".join([str(p) for p in desc_parts if p])
     
-    for token in query_data.get("text_tokens", []):
-        # Sanitize token for SQL/Regex safety
-        safe_token = token.replace("'", "").replace("%", "")
-        
-        # Calculate accent-insensitive regex for ALL tokens first
-        # Example: "mio" -> "m[ií]o"
-        fuzzy_token = to_accent_regex(safe_token)
-        
-        if len(safe_token) > 3:
-            # LONG TOKENS: Accent-Insensitive Regex Search
-            # Example: "Megane" -> matches "Megane", "Mégane"
-            or_conditions = ",".join([f"{col}.imatch.{fuzzy_token}" for col in target_cols])
-            query = query.or_(or_conditions)
-        else:
-            # SHORT TOKENS: Strict Search (Word Boundary) -> \ytoken\y
-            # Example: "Mio" -> "\ym[ií]o\y" matches "Clio Mío" but NOT "Kamion"
-            regex_pattern = f"\\y{fuzzy_token}\\y"
-            
-            # PostgREST syntax: col.imatch.pattern
-            or_conditions = ",".join([f"{col}.imatch.{regex_pattern}" for col in target_cols])
-            query = query.or_(or_conditions)
-        
-    res = await query.limit(limit).execute()
-    return res.data
+    return {
+        "id": str(v['vehicle_id']),
+        "title": title_str[:24],
+        "description": full_desc[:72]
+    }
 
-async def process_search_request(chat_id: str, text_body: str, status: str):
+async def send_model_picker(chat_id: str, brand: str, models: Sequence[str]):
+    """Asks which model of `brand` (sorted, 2+ models) the user means."""
+    # If small list (2-10 items), send INTERACTIVE LIST
+    if len(models) <= 10:
+        # ID format: cmd_search_Brand Model; title limited to 24 chars
+        list_rows = [
+            {"id": f"cmd_search_{brand} {m}", "title": m[:24], "description": "Ver versiones"}
+            for m in models
+        ]
+        await reply_and_mirror(
+            chat_id, 
+            f"Encontré modelos de {brand}. Seleccioná uno:", 
+            list_rows=list_rows, 
+            list_title="Modelos"
+        )
+    else:
+        # Too many models (>10), fall back to text list
+        models_str = "\n".join([f"• {m}" for m in models[:8]])
+        reply = f"🖐 Encontré muchos **{brand}**. Por favor escribí el modelo:\n\n{models_str}\n\n..."
+        await reply_and_mirror(chat_id, reply)
+
+async def process_search_request(chat_id: str, text_body: str, status: str, pending: dict):
     """
     Centralized Search Handler used by Text inputs and List selections.
+    Status changes are queued in `pending` (written once by process_message).
     """
     try:
-        # 1. Parse
-        q_data = parse_search_query(text_body)
+        # 1. Parse (oversized menu_mode text is feedback: skip the parser and the DB)
+        if len(text_body) > MAX_SEARCH_TEXT_LEN:
+            has_criteria = False
+        else:
+            q_data = parse_search_query(text_body)
+            has_criteria = q_data.get("text_tokens") or q_data.get("year_filter") or q_data.get("engine_filter")
         
-        # 2. Execute
-        vehicles = await search_vehicle(q_data, limit=15)
+        # 2. Execute (nothing left after stop words -> no point querying the DB)
+        if has_criteria:
+            # Brand-only query ("ford", "vw"): model picker from the in-memory index.
+            # Brands with <= 10 vehicles fall through to the search and get the direct list.
+            if not q_data["year_filter"] and not q_data["engine_filter"]:
+                brand_hit = get_brand_models(fold_accents(" ".join(q_data["text_tokens"])))
+                if brand_hit and brand_hit[2] > 10 and len(brand_hit[1]) > 1:
+                    await send_model_picker(chat_id, brand_hit[0], brand_hit[1])
+                    return
+            vehicles = await search_vehicle(q_data, limit=15)
+        elif status == 'menu_mode':
+            vehicles = [] # Treated as feedback below
+        else:
+            await reply_and_mirror(chat_id, SEARCH_TIP)
+            return
         
         # 3. Handle Results
         
         # A. 0 Results
         if not vehicles:
             if status == 'menu_mode':
-                await telegram_crm.send_log_to_admin(chat_id, f"📝 **Feedback:** {text_body}", priority='high')
-                await reply_and_mirror(chat_id, "✅ Gracias. Mensaje recibido, lo revisaremos.", buttons=[{"id": "btn_search_error", "title": "🔍 Buscar otro"}])
-                await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
+                spawn(telegram_crm.send_log_to_admin(chat_id, f"📝 **Feedback:** {text_body}", priority='high'))
+                pending["status"] = "bot"
+                await reply_and_mirror(chat_id, "✅ Gracias. Mensaje recibido, lo revisaremos.", buttons=BTNS_SEARCH_OTHER)
             else:
                 # Log Empty
                 await log_user_event(chat_id, "search_empty", text_body)
@@ -334,36 +700,16 @@ async def process_search_request(chat_id: str, text_body: str, status: str):
         
         # B. Too Many Results (>10)
         elif len(vehicles) > 10:
-            unique_brands = list(set([v['brand_car'] for v in vehicles]))
-            unique_models = sorted(list(set([v['model'] for v in vehicles])))
+            # One pass; dicts as ordered sets (stable brand order for display)
+            brands, models = {}, {}
+            for v in vehicles:
+                brands[v['brand_car']] = None
+                models[v['model']] = None
+            unique_brands, unique_models = list(brands), sorted(models)
             
             # CASE A: Single Brand, Multi Model (Intermediate Selector)
             if len(unique_brands) == 1 and len(unique_models) > 1:
-                
-                # If small list (2-10 items), send INTERACTIVE LIST
-                if 2 <= len(unique_models) <= 10:
-                    list_rows = []
-                    brand = unique_brands[0]
-                    for m in unique_models:
-                        # ID format: cmd_search_Brand Model
-                        # Limit title to 24 chars
-                        list_rows.append({
-                            "id": f"cmd_search_{brand} {m}",
-                            "title": m[:24],
-                            "description": "Ver versiones"
-                        })
-                    
-                    await reply_and_mirror(
-                        chat_id, 
-                        f"Encontré modelos de {brand}. Seleccioná uno:", 
-                        list_rows=list_rows, 
-                        list_title="Modelos"
-                    )
-                else:
-                    # Too many models (>10), fall back to text list
-                    models_str = "\n".join([f"• {m}" for m in unique_models[:8]])
-                    reply = f"🖐 Encontré muchos **{unique_brands[0]}**. Por favor escribí el modelo:\n\n{models_str}\n\n..."
-                    await reply_and_mirror(chat_id, reply)
+                await send_model_picker(chat_id, unique_brands[0], unique_models)
 
             # CASE B: Single Brand, Single Model (Refinement Loop check)
             # CASE C: Mixed Brands
@@ -373,59 +719,7 @@ async def process_search_request(chat_id: str, text_body: str, status: str):
 
         # C. Good Range (1-10)
         else:
-            list_rows = []
-            for v in vehicles:
-                # 1. Fuel Badge Logic
-                f_raw = (v.get('fuel_type') or '').lower()
-                if 'diesel' in f_raw:
-                    fuel_badge = "🛢️ Diesel"
-                elif 'gnc' in f_raw or 'gas' in f_raw:
-                    fuel_badge = "🔥 GNC"
-                elif 'nafta' in f_raw or 'benz' in f_raw:
-                    fuel_badge = "⛽"
-                else:
-                    fuel_badge = ""
-
-                # 2. Build Title (Engine + HP + Valves + Fuel)
-                title_parts = []
-                if v.get('engine_disp_l'): 
-                    title_parts.append(f"{v['engine_disp_l']}L")
-                if v.get('power_hp'): 
-                    title_parts.append(f"{v['power_hp']}CV")
-                if v.get('engine_valves'):
-                    title_parts.append(str(v['engine_valves']))
-                
-                # Append Fuel priority (after engine specs)
-                if fuel_badge:
-                    title_parts.append(fuel_badge)
-
-                title_str = " ".join(title_parts) 
-                if not title_str.strip():
-                    title_str = "Ver Detalles" # Fallback
-                
-                # 3. Description (Brand Model Suffix • Year)
-                # Body type explicitly excluded per requirements
-                y_to = str(v['year_to']) if v.get('year_to') else 'Pres'
-                year_str = f"{v.get('year_from')}-{y_to}" if v.get('year_from') else ""
-                
-                # Merge Model + Suffix
-                model_full = v.get('model', '')
-                if v.get('series_suffix'):
-                    model_full += f" {v['series_suffix']}"
-                
-                desc_parts = [
-                    v.get('brand_car'), 
-                    model_full,
-                    year_str
-                ]
-                # Filter empty and join
-                full_desc = " • ".join([str(p) for p in desc_parts if p])
-                
-                list_rows.append({
-                    "id": str(v['vehicle_id']),
-                    "title": title_str[:24],
-                    "description": full_desc[:72]
-                })
+            list_rows = [vehicle_list_row(v) for v in vehicles]
             
             await reply_and_mirror(
                 chat_id,
@@ -453,9 +747,8 @@ async def send_car_actions(phone: str, vehicle_id: str):
             await reply_and_mirror(phone, "⚠️ No pude recuperar el contexto. Por favor buscá de nuevo.")
             return
 
-        # Fetch minimal vehicle data for context
-        v_res = await supabase.table("vehicle").select("brand_car, model").eq("vehicle_id", vehicle_id).single().execute()
-        v = v_res.data
+        # Context from the card cache (the user just saw this card, so usually no DB hit)
+        v = await get_vehicle_card(vehicle_id)
         if not v:
             await send_whatsapp_message(phone, "⚠️ Vehículo no encontrado.")
             return
@@ -465,7 +758,7 @@ async def send_car_actions(phone: str, vehicle_id: str):
         buttons = [
             {"id": f"btn_buy_loc_{vehicle_id}", "title": "📍 Dónde comprar"},
             {"id": f"btn_menu_mech_{vehicle_id}", "title": "⚙️ Menú / Taller"},
-            {"id": "btn_search_error", "title": "🔍 Buscar otro"}
+            BTN_SEARCH_OTHER
         ]
         
         await reply_and_mirror(phone, text, buttons=buttons)
@@ -474,7 +767,7 @@ async def send_car_actions(phone: str, vehicle_id: str):
         await reply_and_mirror(phone, "⚠️ Error interno recuperando menú.")
 
 # --- Unified Response Wrapper ---
-async def reply_and_mirror(phone: str, text: str, buttons: list = None, list_rows: list = None, list_title: str = None):
+async def reply_and_mirror(phone: str, text: str, buttons: Sequence[Dict] = None, list_rows: list = None, list_title: str = None):
     """
     Sends to WhatsApp AND mirrors the exact content to Telegram.
     """
@@ -502,17 +795,510 @@ async def reply_and_mirror(phone: str, text: str, buttons: list = None, list_row
         if list_rows:
             mirror_msg += f"\n📋 *Mostró Lista:* {len(list_rows)} ítems"
 
-        # 3. Send to Telegram
-        await telegram_crm.send_log_to_admin(phone, mirror_msg, priority='log')
+        # 3. Queue for Telegram (batched by _mirror_flusher)
+        MIRROR_Q.put_nowait((phone, mirror_msg))
     except Exception as e:
         print(f"Telegram Mirror Error: {e}")
 
+def queue_admin_log(phone: str, text: str):
+    """
+    Queues a silent ('log' priority) admin event for the user's topic. It is
+    batched with the reply mirrors by _mirror_flusher, so it keeps their order
+    and shares their Telegram call. 'normal'/'high' alerts still send directly.
+    """
+    MIRROR_Q.put_nowait((phone, text))
+
+# --- Telegram Mirror Batching ---
+async def _send_mirror_batch(batch: Dict[str, List[str]]):
+    """
+    Sends one Telegram log per phone, splitting only when the joined text would
+    exceed Telegram's message size limit. A chunk whose user text breaks the
+    Markdown parse is resent plain by send_log_to_admin, not dropped.
+    """
+    for phone, texts in batch.items():
+        chunks = [texts[0]]
+        for text in texts[1:]:
+            if len(chunks[-1]) + len(text) + 2 > MIRROR_MAX_CHARS:
+                chunks.append(text)
+            else:
+                chunks[-1] += f"\n\n{text}"
+        for chunk in chunks:
+            try:
+                await telegram_crm.send_log_to_admin(phone, chunk, priority='log')
+            except Exception as e:
+                print(f"Telegram Mirror Error: {e}")
+
+async def _mirror_flusher():
+    """
+    Background task: drains MIRROR_Q and coalesces everything that arrives
+    within MIRROR_WINDOW_S into one Telegram message per phone.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        phone, text = await MIRROR_Q.get()
+        batch = defaultdict(list)
+        batch[phone].append(text)
+
+        deadline = loop.time() + MIRROR_WINDOW_S
+        while (timeout := deadline - loop.time()) > 0:
+            try:
+                phone, text = await asyncio.wait_for(MIRROR_Q.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch[phone].append(text)
+
+        await _send_mirror_batch(batch)
+
+async def _drain_mirror_queue():
+    """Flushes whatever is still queued (used on shutdown)."""
+    batch = defaultdict(list)
+    while not MIRROR_Q.empty():
+        phone, text = MIRROR_Q.get_nowait()
+        batch[phone].append(text)
+    if batch:
+        await _send_mirror_batch(batch)
+
 
 # --- Pydantic Models ---
 class MetaWebhookPayload(BaseModel):
     object: str
     entry: List[Dict[str, Any]]
 
+class WebhookAck(BaseModel):
+    status: str
+
+# --- Button Handlers ---
+# One coroutine per interactive button action (see BTN_ID_RE), dispatched from
+# route_message via BUTTON_HANDLERS. Signature: (chat_id, arg, user, pending).
+
+# 1. Add Missing
+async def on_btn_add_missing(chat_id: str, arg: str, user: dict, pending: dict):
+    model_name = arg
+    
+    await log_user_event(chat_id, "request_missing", model_name)
+    spawn(telegram_crm.send_log_to_admin(chat_id, f"📝 Request to ADD: {model_name}", priority='normal'))
+    
+    await reply_and_mirror(chat_id, f"📝 ¡Anotado!\n\nYa le avisé al equipo. Voy a buscar los filtros de {model_name} y los cargo lo antes posible. ¡Gracias! 🚀")
+    await send_whatsapp_message(chat_id, SHORT_WELCOME)
+
+# 2. Human Help (Global & Fallback)
+async def on_btn_human_help(chat_id: str, arg: str, user: dict, pending: dict):
+    pending["status"] = "human"
+    
+    await log_user_event(chat_id, "human_mode_req", "User requested support")
+    spawn(telegram_crm.send_log_to_admin(chat_id, "👤 User requested HUMAN support.", priority='high'))
+    
+    await asyncio.gather(
+        flush_and_retitle(chat_id, pending, 'human', user.get('user_type', 'unknown')),
+        reply_and_mirror(chat_id, "👤 Modo Humano activado.\n\nDejanos tu consulta escrita acá abajo 👇 y te responderemos en cuanto estemos online.", buttons=BTNS_RETURN_BOT),
+    )
+
+# 2b. Return to Bot
+async def on_btn_return_bot(chat_id: str, arg: str, user: dict, pending: dict):
+    pending["status"] = "bot"
+    await reply_and_mirror(chat_id, SHORT_WELCOME)
+    queue_admin_log(chat_id, "🔄 User returned to Bot via Button.")
+
+# 3. Search Retry / Error
+async def on_btn_search_retry(chat_id: str, arg: str, user: dict, pending: dict):
+    await send_whatsapp_message(chat_id, SHORT_WELCOME)
+    # Reset status
+    pending["status"] = "bot"
+
+# 4. Dónde comprar
+async def on_btn_buy_loc(chat_id: str, arg: str, user: dict, pending: dict):
+    pending["status"] = "waiting_buyer_location"
+    await reply_and_mirror(chat_id, "📍 ¿De qué Barrio o Ciudad sos?")
+
+# 5. Menú / Taller
+async def on_btn_menu_mech(chat_id: str, arg: str, user: dict, pending: dict):
+    pending["status"] = "menu_mode"
+    vid = arg or "0"
+
+    reply = "¿Eres colega? Seleccioná una opción.\n\n⚠️ ¿Encontraste un error? Simplemente escribe los detalles aquí y te responderemos."
+    sub_btns = [
+        {"id": "btn_is_mechanic", "title": "🔧 Soy Mecánico"},
+        {"id": "btn_is_seller", "title": "🏪 Soy Vendedor"},
+        {"id": f"btn_back_actions_{vid}", "title": "🔙 Volver"}
+    ]
+    await reply_and_mirror(chat_id, reply, buttons=sub_btns)
+
+async def on_btn_back_actions(chat_id: str, arg: str, user: dict, pending: dict):
+    try:
+        await send_car_actions(chat_id, arg)
+    except Exception as e:
+        await reply_and_mirror(chat_id, "⚠️ Error recuperando menú.")
+
+# START MECHANIC FLOW
+async def on_btn_is_mechanic(chat_id: str, arg: str, user: dict, pending: dict):
+    await log_user_event(chat_id, "funnel_start", "mechanic_registration")
+    pending["status"] = "waiting_mechanic_priority"
+    await reply_and_mirror(chat_id, "🚀 Para optimizar tu perfil: ¿Qué priorizás habitualmente?\n_(Seleccioná o escribí tu respuesta)_", buttons=BTNS_MECH_PRIORITY)
+
+# START SELLER FLOW
+async def on_btn_is_seller(chat_id: str, arg: str, user: dict, pending: dict):
+    await log_user_event(chat_id, "funnel_start", "seller_registration")
+    pending["status"] = "waiting_seller_name"
+    # Ask Name (Step 1)
+    await reply_and_mirror(chat_id, "🏪 Alta de Vendedor: ¿Cómo se llama tu Negocio/Repuestera?", buttons=BTNS_CANCEL_SURVEY)
+
+BUTTON_HANDLERS = {
+    'add_missing': on_btn_add_missing,
+    'human_help': on_btn_human_help,
+    'return_bot': on_btn_return_bot,
+    'search_retry': on_btn_search_retry,
+    'search_error': on_btn_search_retry,
+    'buy_loc': on_btn_buy_loc,
+    'menu_mech': on_btn_menu_mech,
+    'back_actions': on_btn_back_actions,
+    'is_mechanic': on_btn_is_mechanic,
+    'is_seller': on_btn_is_seller,
+}
+
+# --- Funnel State Handlers ---
+# One coroutine per survey waiting_* status, dispatched from route_message via
+# STATE_HANDLERS. Signature: (chat_id, input_val, user, pending).
+
+# A. Mechanic Flow
+async def on_waiting_mechanic_priority(chat_id: str, input_val: str, user: dict, pending: dict):
+    priority_val = 'speed' if SPEED_PRIORITY_RE.search(input_val) else 'price'
+    queue_metadata(pending, {"priority": priority_val})
+    
+    pending["status"] = "waiting_mechanic_name"
+    
+    # Ask Name WITH CANCEL
+    await reply_and_mirror(chat_id, "📝 ¿Cuál es el nombre de tu Taller?", buttons=BTNS_CANCEL_SURVEY)
+
+async def on_waiting_mechanic_name(chat_id: str, input_val: str, user: dict, pending: dict):
+    queue_metadata(pending, {"shop_name": input_val})
+    
+    # Finalize & Update SQL Column 'name'
+    pending.update({
+        "status": "bot", 
+        "user_type": "mechanic",
+        "name": input_val
+    })
+    
+    # Log Event
+    await log_user_event(chat_id, "lead_mechanic", f"Shop: {input_val}")
+    
+    # Admin alert is best-effort: don't let Telegram latency gate the user reply
+    spawn(telegram_crm.send_log_to_admin(chat_id, f"👨‍🔧 Mechanic Registered: {input_val}", priority='high'))
+    
+    await asyncio.gather(
+        flush_and_retitle(chat_id, pending, 'bot', 'mechanic'),
+        reply_and_mirror(chat_id, "✅ **¡Perfil Guardado!**\n\nGracias por sumarte a la Beta. Estamos conectando los primeros talleres con proveedores. Te avisaremos apenas activemos tu cuenta PRO.", buttons=BTNS_SEARCH_PART),
+    )
+
+# B. Seller Flow
+async def on_waiting_seller_name(chat_id: str, input_val: str, user: dict, pending: dict):
+    # Save Name
+    queue_metadata(pending, {"shop_name": input_val})
+    # Update SQL Column 'name', move to Location
+    pending.update({
+        "status": "waiting_seller_location",
+        "name": input_val
+    })
+    
+    # Ask Location
+    await reply_and_mirror(chat_id, "🏪 Alta Vendedor: ¿En qué Ciudad o Zona está tu depósito?\n_(Escribí tu ubicación)_", buttons=BTNS_CANCEL_SURVEY)
+
+async def on_waiting_seller_location(chat_id: str, input_val: str, user: dict, pending: dict):
+    location = WS_RE.sub(" ", input_val)
+    # Location Column AND metadata, written with the status in one UPDATE
+    pending.update({
+        "status": "waiting_seller_logistics",
+        "location": location
+    })
+    queue_metadata(pending, {"location": location})
+    await reply_and_mirror(chat_id, "🚚 ¿Hacés envíos?", buttons=BTNS_LOGISTICS)
+
+async def on_waiting_seller_logistics(chat_id: str, input_val: str, user: dict, pending: dict):
+    # Input is button title
+    logistics_val = 'envios' if SHIPPING_RE.search(input_val) else 'retiro'
+    
+    queue_metadata(pending, {"logistics": logistics_val})
+    # Finalize
+    pending.update({"status": "bot", "user_type": "seller"})
+    
+    # Log Event
+    await log_user_event(chat_id, "lead_seller", f"Logistics: {logistics_val}")
+    
+    spawn(telegram_crm.send_log_to_admin(chat_id, f"🏪 Seller Registered: {logistics_val}", priority='high'))
+    
+    await asyncio.gather(
+        flush_and_retitle(chat_id, pending, 'bot', 'seller'),
+        reply_and_mirror(chat_id, "✅ **¡Datos Recibidos!**\n\nEstamos armando la red de distribución. Te contactaremos personalmente para validar tu zona y empezar a derivarte pedidos.", buttons=BTNS_SEARCH_PART),
+    )
+
+# C. Buyer Flow
+async def on_waiting_buyer_location(chat_id: str, input_val: str, user: dict, pending: dict):
+    location = WS_RE.sub(" ", input_val)
+    # Save location to column AND metadata (one UPDATE with the status)
+    pending.update({
+        "location": location, 
+        "status": "waiting_buyer_urgency"
+    })
+    queue_metadata(pending, {"location": location})
+    await reply_and_mirror(chat_id, "⏳ Para filtrar opciones: ¿Buscás el mejor PRECIO o necesitás el repuesto YA (Cerca)?", buttons=BTNS_URGENCY)
+
+async def on_waiting_buyer_urgency(chat_id: str, input_val: str, user: dict, pending: dict):
+    # "Lo necesito YA" vs "Busco Precio"
+    is_urgent = bool(URGENT_RE.search(input_val))
+    
+    queue_metadata(pending, {"urgency": input_val})
+    pending["status"] = "bot"
+    
+    tag = "🔥" if is_urgent else "💸"
+    
+    # Alert actions (background, the reply doesn't wait on Telegram)
+    if is_urgent:
+        spawn(telegram_crm.send_log_to_admin(chat_id, f"🔥 Buyer Urgency: {input_val}", priority='high'))
+    else:
+        spawn(telegram_crm.send_log_to_admin(chat_id, f"💸 Buyer Inquiry: {input_val}", priority='normal'))
+    
+    # Log Event
+    await log_user_event(chat_id, "lead_buyer", f"Urgency: {input_val}")
+    
+    await reply_and_mirror(chat_id, f"{tag} **¡Pedido Recibido!**\n\nComo estamos en **Fase Beta**, un especialista de nuestra red revisará tu pedido manualmente y te contactará con opciones reales en breve.\n\n🏎️ ¡Gracias por ayudarnos a mejorar!", buttons=BTNS_SEARCH_OTHER)
+
+STATE_HANDLERS = {
+    'waiting_mechanic_priority': on_waiting_mechanic_priority,
+    'waiting_mechanic_name': on_waiting_mechanic_name,
+    'waiting_seller_name': on_waiting_seller_name,
+    'waiting_seller_location': on_waiting_seller_location,
+    'waiting_seller_logistics': on_waiting_seller_logistics,
+    'waiting_buyer_location': on_waiting_buyer_location,
+    'waiting_buyer_urgency': on_waiting_buyer_urgency,
+}
+
+# --- Main Logic ---
+async def process_message(value: dict, msg: dict):
+    """
+    Handles a single inbound WhatsApp message (session, human mode, surveys, bot mode).
+    """
+    chat_id = msg['from'] # Phone number
+    user_name = value.get('contacts', [{}])[0].get('profile', {}).get('name', 'Unknown')
+    msg_type = msg.get('type')
+
+    # 1. Get/Create User & Session Management (one RPC, see sql/002_touch_user.sql)
+    if not supabase: return
+
+    user_res = await supabase.rpc("touch_user", {"p_phone": chat_id, "p_name": user_name}).execute()
+    user = user_res.data if user_res else None
+    if not user: return
+    
+    # users column changes for this message, written once at the end
+    pending: Dict[str, Any] = {}
+    
+    if user.pop("was_new", False):
+        # Create the topic off the reply path; later logs wait on its lock
+        spawn(telegram_crm.get_or_create_topic(chat_id, user_name))
+    else:
+        # Topic id is already on the row: skip the lookup on every log
+        telegram_crm.remember_topic(chat_id, user.get("telegram_topic_id"))
+
+    # Human session idled > 60 min: the RPC already reset status to 'bot'
+    if user.pop("session_expired", False):
+        # Log to CRM (Silent/Log priority, no user alert needed)
+        queue_admin_log(chat_id, "ℹ️ Sesión expirada. Bot reactivado.")
+
+    try:
+        await route_message(chat_id, msg, msg_type, user, pending)
+    finally:
+        # A single users UPDATE per message, whichever branch ran
+        await flush_user_fields(chat_id, pending)
+
+async def route_message(chat_id: str, msg: dict, msg_type: str, user: dict, pending: dict):
+    """
+    Hybrid routing for one message. Branches queue users column changes and
+    metadata patches in `pending`; process_message writes them once when
+    routing returns.
+    """
+    # Refresh local status
+    status = user.get('status', 'bot')
+
+    # 2. Hybrid Routing
+    
+    # --- HUMAN MODE ---
+    if status == 'human':
+        text_body = ""
+        if msg_type == 'text':
+            text_body = msg['text']['body']
+        elif msg_type == 'interactive':
+            # Even buttons might be sent in human mode if they click old ones?
+            # Or maybe "Return to Bot" button
+            if msg['interactive']['type'] == 'button_reply':
+                if msg['interactive']['button_reply']['id'] == 'btn_return_bot':
+                    # SWITCH TO BOT
+                    pending["status"] = "bot"
+                    await reply_and_mirror(chat_id, WELCOME_TEXT)
+                    queue_admin_log(chat_id, "🔄 User returned to Bot.")
+                    return
+        
+        
+        # Check keywords to break out
+        if text_body and text_body.lower().strip() in HUMAN_EXIT_KEYWORDS:
+            # Switch back to bot
+            pending["status"] = "bot"
+            await reply_and_mirror(chat_id, WELCOME_TEXT)
+            queue_admin_log(chat_id, f"🔄 User detected keyword '{text_body}'. Bot Active.")
+            # Stop processing
+            return
+        else:
+            # Just forward to Telegram (awaited: the agent must see messages in order)
+            if text_body:
+                await telegram_crm.send_log_to_admin(chat_id, f"📩 {text_body}")
+            else:
+                await telegram_crm.send_log_to_admin(chat_id, f"📩 [Media/Other Message Type]")
+            # STOP here
+            return
+
+    # --- SMART SURVEYS (Refined Logic) ---
+    
+    input_val = get_message_content(msg).strip()
+    
+    # 1. Global Cancel Check
+    # Check keywords or explicit cancel button
+    is_cancel_btn = (msg_type == 'interactive' and 
+                     msg.get('interactive', {}).get('button_reply', {}).get('id') == 'btn_cancel_survey')
+    
+    if (input_val.lower() in CANCEL_KEYWORDS) or is_cancel_btn:
+        # Reset to bot
+        pending["status"] = "bot"
+        queue_admin_log(chat_id, "🚫 User cancelled survey.")
+        await reply_and_mirror(chat_id, SHORT_WELCOME, buttons=BTNS_SEARCH_PART)
+        return
+
+    # 2. Funnel steps: one handler per waiting_* status
+    handler = STATE_HANDLERS.get(status)
+    if handler and input_val:
+        await handler(chat_id, input_val, user, pending)
+        return
+
+    # --- BOT MODE (Standard & Menu) ---
+    if status in ['bot', 'menu_mode']:
+        
+        # A. Search Logic (Text)
+        if msg_type == 'text':
+            text_body = msg['text']['body'].strip()
+            
+            # Bound search input before any logging, mirroring or DB work
+            if status == 'bot' and len(text_body) > MAX_SEARCH_TEXT_LEN:
+                await reply_and_mirror(chat_id, SEARCH_TOO_LONG)
+                return
+            
+            # LOGGING LOGIC
+            if status == 'menu_mode':
+                # Feedback/Error Reporting
+                await log_to_db(chat_id, 'user_feedback', text_body, payload=msg)
+            else:
+                # Standard Search
+                await log_to_db(chat_id, 'search_text', text_body, payload=msg)
+            
+            LOG_TAG = f"🔍 Buscó: {text_body}"
+            # Silent Mirroring to Telegram
+            queue_admin_log(chat_id, LOG_TAG)
+            
+            # Greetings short-circuit before any parsing or DB work
+            if text_body.lower() in GREETING_KEYWORDS:
+                await reply_and_mirror(chat_id, WELCOME_TEXT)
+                return
+
+            # --- SEARCH ENGINE V2 (Refactored) ---
+            await process_search_request(chat_id, text_body, status, pending)
+
+        # B. Vehicle Card (List Selection)
+        elif msg_type == 'interactive' and msg['interactive']['type'] == 'list_reply':
+            vid = msg['interactive']['list_reply']['id']
+            
+            # Check if it's a "Search Command" (Model Selector)
+            if vid.startswith("cmd_search_"):
+                # Extract query (e.g., "Toyota Hilux")
+                # Format: "cmd_search_Brand Model"
+                new_query = vid.replace("cmd_search_", "")
+                
+                # Log click
+                queue_admin_log(chat_id, f"👆 List Selection: {new_query}")
+                
+                # Treat as text search
+                await process_search_request(chat_id, new_query, status, pending)
+                return
+            
+            # --- VEHICLE DETAILS ---
+            # Fetch Vehicle + Parts (cached, one round trip on a miss)
+            vehicle = await get_vehicle_card(vid)
+            if not vehicle: return
+
+            # Log selection
+            sel_brand = vehicle.get('brand_car', '')
+            sel_model = vehicle.get('model', '')
+            sel_year = f"{vehicle.get('year_from', '?')}-{vehicle.get('year_to') or 'Pres'}"
+            queue_admin_log(chat_id, f"👆 Seleccionó: {sel_brand} {sel_model} ({sel_year})")
+
+            # Card text is rendered once per fetch (get_vehicle_card)
+            msg_body = vehicle['card_text']
+
+            # 3 Action Buttons
+            buttons = [
+                {"id": f"btn_buy_loc_{vid}", "title": "📍 Dónde comprar"},
+                {"id": f"btn_menu_mech_{vid}", "title": "⚙️ Menú / Taller"},
+                BTN_SEARCH_OTHER
+            ]
+            await reply_and_mirror(chat_id, msg_body, buttons=buttons)
+
+        # C. General Button Handlers
+        elif msg_type == 'interactive' and msg['interactive']['type'] == 'button_reply':
+            btn_id = msg['interactive']['button_reply']['id']
+            btn_title = msg['interactive']['button_reply']['title']
+            
+            queue_admin_log(chat_id, f"👆 Click: {btn_title}")
+
+            # One regex match + dict dispatch instead of a startswith/elif cascade
+            btn_match = BTN_ID_RE.match(btn_id)
+            action = btn_match.group('action') if btn_match else None
+            btn_arg = (btn_match.group('arg') if btn_match else None) or ""
+
+            handler = BUTTON_HANDLERS.get(action)
+            if handler:
+                await handler(chat_id, btn_arg, user, pending)
+
+async def process_in_order(value: dict, msg: dict):
+    """
+    Runs process_message off the request path: serialized per phone, and
+    capped by PROCESSING_SEMAPHORE across phones.
+    """
+    phone = msg['from']
+    lock = PHONE_LOCKS.setdefault(phone, asyncio.Lock())
+    PHONE_INFLIGHT[phone] += 1
+    try:
+        async with lock, PROCESSING_SEMAPHORE:
+            await process_message(value, msg)
+    finally:
+        PHONE_INFLIGHT[phone] -= 1
+        if not PHONE_INFLIGHT[phone]:
+            del PHONE_INFLIGHT[phone]
+            PHONE_LOCKS.pop(phone, None)
+
+
+# --- Cache Metrics ---
+@app.get("/metrics")
+async def metrics(request: Request) -> dict:
+    """
+    In-process cache effectiveness (per worker; resets on restart).
+    Only served when METRICS_TOKEN is set and sent as `Authorization: Bearer <token>`;
+    otherwise the route answers 404 like any unknown path.
+    """
+    auth = request.headers.get("authorization", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=404, detail="Not Found")
+    parse_info = _parse_search_query.cache_info()
+    return {
+        "parse": {"hit": parse_info.hits, "miss": parse_info.misses, "size": parse_info.currsize},
+        "search": {"hit": CACHE_STATS["search_hit"], "miss": CACHE_STATS["search_miss"], "size": len(SEARCH_CACHE)},
+        "card": {"hit": CACHE_STATS["card_hit"], "miss": CACHE_STATS["card_miss"], "size": len(VEHICLE_CARD_CACHE)},
+    }
+
 # --- Webhook Verification ---
 @app.get("/webhook")
 async def verify_webhook(
@@ -524,475 +1310,54 @@ async def verify_webhook(
         return Response(content=challenge, media_type="text/plain")
     raise HTTPException(status_code=403, detail="Verification failed")
 
-# --- Main Logic ---
+# --- Webhook Entry ---
 @app.post("/webhook")
-async def webhook(payload: MetaWebhookPayload):
+async def webhook(request: Request) -> WebhookAck:
     """
     Main Hybrid Flow Logic
     """
+    # Parse + validate the raw body in pydantic-core (one Rust pass) instead of
+    # FastAPI's stdlib json.loads followed by model validation
+    try:
+        payload = MetaWebhookPayload.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
     for entry in payload.entry:
         for change in entry.get('changes', []):
             value = change.get('value', {})
+            messages = value.get('messages', [])
+            
+            if not messages:
+                continue
+
+            # Inbound envelope: bound once, never rebound below
+            msg = messages[0]
             
             # --- NEW: STALE FILTER ---
             try:
-                if 'messages' in value:
-                    msg = value['messages'][0]
-                    raw_ts = msg.get('timestamp')
-                    if raw_ts:
-                        msg_dt = datetime.fromtimestamp(int(raw_ts), tz=timezone.utc)
-                        if (datetime.now(timezone.utc) - msg_dt).total_seconds() > 300:
-                            print(f"⌛ Ignoring STALE message from {msg_dt}")
-                            return JSONResponse(content={"status": "ignored_stale"}, status_code=200)
+                raw_ts = msg.get('timestamp')
+                # Meta sends epoch seconds: compare numbers directly
+                if raw_ts and time.time() - int(raw_ts) > 300:
+                    print(f"⌛ Ignoring STALE message from ts={raw_ts}")
+                    return WebhookAck(status="ignored_stale")
             except Exception as e:
                 print(f"Time check error: {e}")
             # -------------------------
             
             # --- DEDUPLICATION ---
             try:
-                if 'messages' in value:
-                    msg_id = value['messages'][0].get('id')
-                    
-                    # If ID was already processed, stop immediately (return 200 OK)
-                    if msg_id and msg_id in PROCESSED_MSG_IDS:
-                        print(f"🔁 Ignoring retry: {msg_id}")
-                        return JSONResponse(content={"status": "ignored_duplicate"}, status_code=200)
-                    
-                    if msg_id:
-                        PROCESSED_MSG_IDS.append(msg_id)
+                msg_id = msg.get('id')
+                
+                # If ID was already processed, stop immediately (return 200 OK)
+                if msg_id and seen_message(msg_id):
+                    print(f"🔁 Ignoring retry: {msg_id}")
+                    return WebhookAck(status="ignored_duplicate")
             except Exception as e:
                 print(f"Dedup error: {e}")
             # ---------------------
 
-            messages = value.get('messages', [])
-            
-            if not messages:
-                continue
-
-            msg = messages[0]
-            chat_id = msg['from'] # Phone number
-            user_name = value.get('contacts', [{}])[0].get('profile', {}).get('name', 'Unknown')
-            msg_type = msg.get('type')
-
-            # 1. Get/Create User & Session Management
-            if not supabase: continue
-
-            user_res = await supabase.table("users").select("*").eq("phone", chat_id).maybe_single().execute()
-            user = user_res.data if user_res else None
-            
-            now = datetime.now(timezone.utc)
-            
-            if not user:
-                # Create new user
-                user = {
-                    "phone": chat_id,
-                    "name": user_name,
-                    "status": "bot",
-                    "user_type": "unknown",
-                    "last_active_at": now.isoformat()
-                }
-                await supabase.table("users").insert(user).execute()
-                # Also ensure topic exists just in case
-                await telegram_crm.get_or_create_topic(chat_id, user_name)
-            else:
-                # Session Timeout Logic
-                last_active_str = user.get("last_active_at")
-                current_status = user.get("status", "bot")
-                
-                # Check timeout for Humans
-                if current_status == 'human' and last_active_str:
-                    try:
-                        # Handle varied timestamp formats if needed, usually ISO from Supabase
-                        last_active = datetime.fromisoformat(last_active_str.replace("Z", "+00:00"))
-                        if (now - last_active) > timedelta(minutes=60):
-                            # Reset to bot
-                            await supabase.table("users").update({"status": "bot", "last_active_at": now.isoformat()}).eq("phone", chat_id).execute()
-                            user['status'] = 'bot' # Update local var
-                            # Log to CRM (Silent/Log priority, no user alert needed)
-                            await telegram_crm.send_log_to_admin(chat_id, "ℹ️ Sesión expirada. Bot reactivado.", priority='log')
-                    except Exception as e:
-                        print(f"Time check error: {e}")
-
-                # Update Last Active
-                await supabase.table("users").update({"last_active_at": now.isoformat()}).eq("phone", chat_id).execute()
-
-            # Refresh local status
-            status = user.get('status', 'bot')
-
-            # 2. Hybrid Routing
-            
-            # --- HUMAN MODE ---
-            if status == 'human':
-                text_body = ""
-                if msg_type == 'text':
-                    text_body = msg['text']['body']
-                elif msg_type == 'interactive':
-                    # Even buttons might be sent in human mode if they click old ones?
-                    # Or maybe "Return to Bot" button
-                    if msg['interactive']['type'] == 'button_reply':
-                        if msg['interactive']['button_reply']['id'] == 'btn_return_bot':
-                            # SWITCH TO BOT
-                            await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                            await reply_and_mirror(chat_id, WELCOME_TEXT)
-                            await telegram_crm.send_log_to_admin(chat_id, "🔄 User returned to Bot.", priority='log')
-                            continue
-                
-                
-                # Check keywords to break out
-                keywords = ["menu", "start", "bot", "volver", "inicio"]
-                if text_body and text_body.lower().strip() in keywords:
-                    # Switch back to bot
-                    await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                    await reply_and_mirror(chat_id, WELCOME_TEXT)
-                    await telegram_crm.send_log_to_admin(chat_id, f"🔄 User detected keyword '{text_body}'. Bot Active.", priority='log')
-                    # Stop processing
-                    continue
-                else:
-                    # Just forward to Telegram
-                    if text_body:
-                        await telegram_crm.send_log_to_admin(chat_id, f"📩 {text_body}")
-                    else:
-                        await telegram_crm.send_log_to_admin(chat_id, f"📩 [Media/Other Message Type]")
-                    # STOP here
-                    continue
-
-            # --- SMART SURVEYS (Refined Logic) ---
-            
-            input_val = get_message_content(msg).strip()
-            
-            # 1. Global Cancel Check
-            # Check keywords or explicit cancel button
-            is_cancel_btn = (msg_type == 'interactive' and 
-                             msg.get('interactive', {}).get('button_reply', {}).get('id') == 'btn_cancel_survey')
-            
-            cancel_keywords = ['cancelar', 'salir', 'menu', 'basta', 'chau', 'volver']
-            
-            if (input_val.lower() in cancel_keywords) or is_cancel_btn:
-                # Reset to bot
-                await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                await telegram_crm.send_log_to_admin(chat_id, "🚫 User cancelled survey.", priority='log')
-                await reply_and_mirror(chat_id, SHORT_WELCOME, buttons=[{"id": "btn_search_error", "title": "🔍 Buscar repuesto"}])
-                continue
+            # Ack Meta right away; the work runs after the response
+            spawn(process_in_order(value, msg))
 
-            # A. Mechanic Flow
-            if status == 'waiting_mechanic_priority':
-                if input_val:
-                    priority_val = 'speed' if 'velocidad' in input_val.lower() or 'rocket' in input_val.lower() else 'price'
-                    await update_user_metadata(chat_id, {"priority": priority_val})
-                    
-                    await supabase.table("users").update({"status": "waiting_mechanic_name"}).eq("phone", chat_id).execute()
-                    
-                    # Ask Name WITH CANCEL
-                    btns = [{"id": "btn_cancel_survey", "title": "🔙 Cancelar"}]
-                    await reply_and_mirror(chat_id, "📝 ¿Cuál es el nombre de tu Taller?", buttons=btns)
-                    continue
-
-            elif status == 'waiting_mechanic_name':
-                if input_val:
-                    await update_user_metadata(chat_id, {"shop_name": input_val})
-                    
-                    # Finalize & Update SQL Column 'name'
-                    await supabase.table("users").update({
-                        "status": "bot", 
-                        "user_type": "mechanic",
-                        "name": input_val
-                    }).eq("phone", chat_id).execute()
-                    
-                    # Log Event
-                    await log_user_event(chat_id, "lead_mechanic", f"Shop: {input_val}")
-
-                    await telegram_crm.update_topic_title(chat_id, 'bot', 'mechanic')
-                    await telegram_crm.send_log_to_admin(chat_id, f"👨‍🔧 Mechanic Registered: {input_val}", priority='high')
-                    
-                    await reply_and_mirror(chat_id, "✅ **¡Perfil Guardado!**\n\nGracias por sumarte a la Beta. Estamos conectando los primeros talleres con proveedores. Te avisaremos apenas activemos tu cuenta PRO.", buttons=[{"id": "btn_search_error", "title": "🔍 Buscar repuesto"}])
-                    continue
-
-            # B. Seller Flow
-            elif status == 'waiting_seller_name':
-                if input_val:
-                    # Save Name
-                    await update_user_metadata(chat_id, {"shop_name": input_val})
-                    # Update SQL Column 'name', move to Location
-                    await supabase.table("users").update({
-                        "status": "waiting_seller_location",
-                        "name": input_val
-                    }).eq("phone", chat_id).execute()
-                    
-                    # Ask Location
-                    btns = [{"id": "btn_cancel_survey", "title": "🔙 Cancelar"}]
-                    await reply_and_mirror(chat_id, "🏪 Alta Vendedor: ¿En qué Ciudad o Zona está tu depósito?\n_(Escribí tu ubicación)_", buttons=btns)
-                    continue
-
-            elif status == 'waiting_seller_location':
-                if input_val:
-                    await update_user_metadata(chat_id, {"location": input_val})
-                    
-                    # Update Location Column
-                    await supabase.table("users").update({
-                        "status": "waiting_seller_logistics",
-                        "location": input_val
-                    }).eq("phone", chat_id).execute()
-                    
-                    # Ask Logistics (Buttons)
-                    btns = [
-                        {"id": "btn_logistics_ship", "title": "📦 Hago Envíos"},
-                        {"id": "btn_logistics_pickup", "title": "🏪 Solo Retiro"},
-                        {"id": "btn_cancel_survey", "title": "🔙 Cancelar"}
-                    ]
-                    await reply_and_mirror(chat_id, "🚚 ¿Hacés envíos?", buttons=btns)
-                    continue
-            
-            elif status == 'waiting_seller_logistics':
-                if input_val:
-                    # Input is button title
-                    logistics_val = 'envios' if 'envíos' in input_val.lower() else 'retiro'
-                    
-                    await update_user_metadata(chat_id, {"logistics": logistics_val})
-                    # Finalize
-                    await supabase.table("users").update({"status": "bot", "user_type": "seller"}).eq("phone", chat_id).execute()
-                    
-                    # Log Event
-                    await log_user_event(chat_id, "lead_seller", f"Logistics: {logistics_val}")
-
-                    await telegram_crm.update_topic_title(chat_id, 'bot', 'seller')
-                    await telegram_crm.send_log_to_admin(chat_id, f"🏪 Seller Registered: {logistics_val}", priority='high')
-                    
-                    await reply_and_mirror(chat_id, "✅ **¡Datos Recibidos!**\n\nEstamos armando la red de distribución. Te contactaremos personalmente para validar tu zona y empezar a derivarte pedidos.", buttons=[{"id": "btn_search_error", "title": "🔍 Buscar repuesto"}])
-                    continue
-
-            # C. Buyer Flow
-            elif status == 'waiting_buyer_location':
-                if input_val:
-                    # Save location to column AND metadata
-                    await update_user_metadata(chat_id, {"location": input_val})
-                    
-                    await supabase.table("users").update({
-                        "location": input_val, 
-                        "status": "waiting_buyer_urgency"
-                    }).eq("phone", chat_id).execute()
-                    
-                    # Ask Urgency (Refined Copy & Buttons)
-                    btns = [
-                        {"id": "btn_urgency_high", "title": "🔥 Lo necesito YA"},
-                        {"id": "btn_urgency_normal", "title": "💰 Busco Precio"},
-                        {"id": "btn_cancel_survey", "title": "🔙 Cancelar"}
-                    ]
-                    await reply_and_mirror(chat_id, "⏳ Para filtrar opciones: ¿Buscás el mejor PRECIO o necesitás el repuesto YA (Cerca)?", buttons=btns)
-                    continue
-
-            elif status == 'waiting_buyer_urgency':
-                if input_val:
-                    # "Lo necesito YA" vs "Busco Precio"
-                    is_urgent = 'ya' in input_val.lower() or 'fuego' in input_val.lower() or '🔥' in input_val
-                    
-                    await update_user_metadata(chat_id, {"urgency": input_val})
-                    await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                    
-                    tag = "🔥" if is_urgent else "💸"
-                    
-                    # Alert actions
-                    if is_urgent:
-                        await telegram_crm.send_log_to_admin(chat_id, f"🔥 Buyer Urgency: {input_val}", priority='high')
-                    else:
-                        await telegram_crm.send_log_to_admin(chat_id, f"💸 Buyer Inquiry: {input_val}", priority='normal')
-                    
-                    # Log Event
-                    await log_user_event(chat_id, "lead_buyer", f"Urgency: {input_val}")
-
-                    await reply_and_mirror(chat_id, f"{tag} **¡Pedido Recibido!**\n\nComo estamos en **Fase Beta**, un especialista de nuestra red revisará tu pedido manualmente y te contactará con opciones reales en breve.\n\n🏎️ ¡Gracias por ayudarnos a mejorar!", buttons=[{"id": "btn_search_error", "title": "🔍 Buscar otro"}])
-                    continue
-
-            # --- BOT MODE (Standard & Menu) ---
-            if status in ['bot', 'menu_mode']:
-                
-                # A. Search Logic (Text)
-                if msg_type == 'text':
-                    text_body = msg['text']['body'].strip()
-                    
-                    # LOGGING LOGIC
-                    if status == 'menu_mode':
-                        # Feedback/Error Reporting
-                        await log_to_db(chat_id, 'user_feedback', text_body, payload=msg)
-                    else:
-                        # Standard Search
-                        await log_to_db(chat_id, 'search_text', text_body, payload=msg)
-                    
-                    # Sanitize for SQL/Supabase filter to prevent syntax errors
-                    search_term = text_body.replace(',', '').replace('(', '').replace(')', '').replace("'", "")
-                    
-                    LOG_TAG = f"🔍 Buscó: {text_body}"
-                    # Silent Mirroring to Telegram
-                    await telegram_crm.send_log_to_admin(chat_id, LOG_TAG, priority='log')
-                    
-                    # Check "Hola" logic or Stop Words if desired, but "Search Logic" is main focus
-                    stop_words_greetings = ['hola', 'start', 'hi', 'hello', 'menú', 'menu']
-                    if text_body.lower() in stop_words_greetings:
-                        await reply_and_mirror(chat_id, WELCOME_TEXT)
-                    else:
-                        # --- SEARCH ENGINE V2 (Refactored) ---
-                        await process_search_request(chat_id, text_body, status)
-
-                # B. Vehicle Card (List Selection)
-                elif msg_type == 'interactive' and msg['interactive']['type'] == 'list_reply':
-                    vid = msg['interactive']['list_reply']['id']
-                    
-                    # Check if it's a "Search Command" (Model Selector)
-                    if vid.startswith("cmd_search_"):
-                        # Extract query (e.g., "Toyota Hilux")
-                        # Format: "cmd_search_Brand Model"
-                        new_query = vid.replace("cmd_search_", "")
-                        
-                        # Log click
-                        await telegram_crm.send_log_to_admin(chat_id, f"👆 List Selection: {new_query}", priority='log')
-                        
-                        # Treat as text search
-                        await process_search_request(chat_id, new_query, status)
-                        continue
-                    
-                    # --- VEHICLE DETAILS ---
-                    # Fetch Vehicle
-                    v_res = await supabase.table("vehicle").select("*").eq("vehicle_id", vid).single().execute()
-                    vehicle = v_res.data
-                    if not vehicle: continue
-
-                    # Log selection
-                    sel_brand = vehicle.get('brand_car', '')
-                    sel_model = vehicle.get('model', '')
-                    sel_year = f"{vehicle.get('year_from', '?')}-{vehicle.get('year_to') or 'Pres'}"
-                    await telegram_crm.send_log_to_admin(chat_id, f"👆 Seleccionó: {sel_brand} {sel_model} ({sel_year})", priority='log')
-
-                    # Fetch Parts
-                    parts_res = await supabase.table("vehicle_part").select("role, part(brand_filter, part_code, part_type)").eq("vehicle_id", vid).execute()
-                    
-                    # Build Message
-                    display_title = f"{vehicle.get('brand_car')} {vehicle.get('model')}"
-                    msg_body = f"🚗 **{display_title}**\n\n"
-                    
-                    found_parts = {}
-                    for item in parts_res.data:
-                        part = item.get('part')
-                        if part:
-                            ptype = part.get('part_type', 'other').lower()
-                            code = part.get('part_code', '').replace('*', '')
-                            line = f"• {part.get('brand_filter')}: {code}"
-                            found_parts.setdefault(ptype, []).append(line)
-                    
-                    type_dic = {'oil': '🛢️ Aceite', 'air': '💨 Aire', 'cabin': '❄️ Habitáculo', 'fuel': '⛽ Combustible'}
-                    for k, label in type_dic.items():
-                        if k in found_parts:
-                            msg_body += f"{label}\n" + "\n".join(found_parts[k]) + "\n\n"
-                    
-                    if not found_parts: msg_body += "⚠️ Sin filtros cargados.\n"
-                    
-                    # Add Mechanic/Pro Tech Info (Engine Series/Code)
-                    # UX: Subtle footer
-                    eng_code = vehicle.get('engine_code')
-                    eng_series = vehicle.get('engine_series')
-                    
-                    if eng_code or eng_series:
-                        tech_info = []
-                        if eng_series: tech_info.append(f"Serie: {eng_series}")
-                        if eng_code: tech_info.append(f"Motor: {eng_code}")
-                        
-                        msg_body += f"\n🔧 {' | '.join(tech_info)}"
-
-                    # 3 Action Buttons
-                    buttons = [
-                        {"id": f"btn_buy_loc_{vid}", "title": "📍 Dónde comprar"},
-                        {"id": f"btn_menu_mech_{vid}", "title": "⚙️ Menú / Taller"},
-                        {"id": "btn_search_error", "title": "🔍 Buscar otro"} 
-                    ]
-                    await reply_and_mirror(chat_id, msg_body, buttons=buttons)
-
-                # C. General Button Handlers
-                elif msg_type == 'interactive' and msg['interactive']['type'] == 'button_reply':
-                    btn_id = msg['interactive']['button_reply']['id']
-                    btn_title = msg['interactive']['button_reply']['title']
-                    
-                    await telegram_crm.send_log_to_admin(chat_id, f"👆 Click: {btn_title}", priority='log')
-
-                    # 1. Add Missing
-                    if btn_id.startswith("btn_add_missing_"):
-                        model_name = btn_id.split("btn_add_missing_")[1]
-                        
-                        await log_user_event(chat_id, "request_missing", model_name)
-                        await telegram_crm.send_log_to_admin(chat_id, f"📝 Request to ADD: {model_name}", priority='normal')
-                        
-                        await reply_and_mirror(chat_id, f"📝 ¡Anotado!\n\nYa le avisé al equipo. Voy a buscar los filtros de {model_name} y los cargo lo antes posible. ¡Gracias! 🚀")
-                        await send_whatsapp_message(chat_id, SHORT_WELCOME)
-                        continue
-
-                    # 2. Human Help (Global & Fallback)
-                    elif btn_id == "btn_human_help":
-                        await supabase.table("users").update({"status": "human"}).eq("phone", chat_id).execute()
-                        await telegram_crm.update_topic_title(chat_id, 'human', user.get('user_type', 'unknown'))
-                        
-                        await log_user_event(chat_id, "human_mode_req", "User requested support")
-                        await telegram_crm.send_log_to_admin(chat_id, "👤 User requested HUMAN support.", priority='high')
-                        
-                        await reply_and_mirror(chat_id, "👤 Modo Humano activado.\n\nDejanos tu consulta escrita acá abajo 👇 y te responderemos en cuanto estemos online.", buttons=[{"id": "btn_return_bot", "title": "🤖 Volver al Bot"}])
-                        continue
-
-                    # 2b. Return to Bot
-                    elif btn_id == 'btn_return_bot':
-                         await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                         await reply_and_mirror(chat_id, SHORT_WELCOME)
-                         await telegram_crm.send_log_to_admin(chat_id, "🔄 User returned to Bot via Button.", priority='log')
-
-                    # 3. Search Retry / Error
-                    elif btn_id == "btn_search_retry" or btn_id == "btn_search_error":
-                        await send_whatsapp_message(chat_id, SHORT_WELCOME)
-                        # Reset status
-                        await supabase.table("users").update({"status": "bot"}).eq("phone", chat_id).execute()
-                        continue
-
-                    # 4. Dónde comprar
-                    elif btn_id.startswith('btn_buy_loc'):
-                        await supabase.table("users").update({"status": "waiting_buyer_location"}).eq("phone", chat_id).execute()
-                        await reply_and_mirror(chat_id, "📍 ¿De qué Barrio o Ciudad sos?")
-                    
-                    # 5. Menú / Taller
-                    elif btn_id.startswith('btn_menu_mech'):
-                        await supabase.table("users").update({"status": "menu_mode"}).eq("phone", chat_id).execute()
-                        try:
-                            vid = btn_id.split('_')[-1]
-                        except:
-                            vid = "0"
-
-                        reply = "¿Eres colega? Seleccioná una opción.\n\n⚠️ ¿Encontraste un error? Simplemente escribe los detalles aquí y te responderemos."
-                        sub_btns = [
-                            {"id": "btn_is_mechanic", "title": "🔧 Soy Mecánico"},
-                            {"id": "btn_is_seller", "title": "🏪 Soy Vendedor"},
-                            {"id": f"btn_back_actions_{vid}", "title": "🔙 Volver"}
-                        ]
-                        await reply_and_mirror(chat_id, reply, buttons=sub_btns)
-
-                    elif btn_id.startswith('btn_back_actions'):
-                        try:
-                            vid = btn_id.split('_')[-1]
-                            await send_car_actions(chat_id, vid)
-                        except Exception as e:
-                            await reply_and_mirror(chat_id, "⚠️ Error recuperando menú.")
-
-                    # START MECHANIC FLOW
-                    elif btn_id == 'btn_is_mechanic':
-                        await log_user_event(chat_id, "funnel_start", "mechanic_registration")
-                        await supabase.table("users").update({"status": "waiting_mechanic_priority"}).eq("phone", chat_id).execute()
-                        btns = [
-                            {"id": "btn_prio_speed", "title": "🚀 Velocidad"},
-                            {"id": "btn_prio_price", "title": "💰 Precio"},
-                            {"id": "btn_cancel_survey", "title": "🔙 Cancelar"}
-                        ]
-                        await reply_and_mirror(chat_id, "🚀 Para optimizar tu perfil: ¿Qué priorizás habitualmente?\n_(Seleccioná o escribí tu respuesta)_", buttons=btns)
-
-                    # START SELLER FLOW
-                    elif btn_id == 'btn_is_seller':
-                         await log_user_event(chat_id, "funnel_start", "seller_registration")
-                         await supabase.table("users").update({"status": "waiting_seller_name"}).eq("phone", chat_id).execute()
-                         # Ask Name (Step 1)
-                         btns = [{"id": "btn_cancel_survey", "title": "🔙 Cancelar"}]
-                         await reply_and_mirror(chat_id, "🏪 Alta de Vendedor: ¿Cómo se llama tu Negocio/Repuestera?", buttons=btns)
-
-
-
-    return {"status": "ok"}
+    return WebhookAck(status="ok")
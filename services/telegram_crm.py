@@ -1,9 +1,11 @@
 import os
 import asyncio
+from typing import Dict, Optional
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Message, ForumTopic, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
 from supabase import AsyncClient
 from services.whatsapp import send_whatsapp_message, send_interactive_buttons
 
@@ -17,7 +19,7 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 
 # Initialize Supabase
 supabase: AsyncClient = None
-# Initialization will happen in bot.py logic or explicitly
+# Initialization will happen in bot.py / worker_telegram.py or explicitly
 
 
 # Initialize Router
@@ -27,6 +29,11 @@ admin_router = Router()
 bot_instance = None
 dp_instance = None
 
+# Topic cache (phone -> telegram_topic_id). Saves a users SELECT on every log.
+TOPIC_IDS: Dict[str, int] = {}
+# Per-phone locks so concurrent logs for a new user create a single topic
+_topic_locks: Dict[str, asyncio.Lock] = {}
+
 def get_bot():
     """
     Returns the singleton Bot instance.
@@ -51,7 +58,7 @@ def get_bot():
 async def start_telegram():
     """
     Initializes the Bot and Dispatcher as Singletons.
-    Returns the dispatcher and bot instance for the lifespan handler.
+    Returns the bot and dispatcher instance for the polling worker (worker_telegram.py).
     """
     global bot_instance, dp_instance
     
@@ -73,15 +80,43 @@ async def start_telegram():
 
 # --- Topic Management ---
 
+def remember_topic(phone: str, topic_id) -> None:
+    """
+    Caches a topic_id already known from the users row (telegram_topic_id).
+    """
+    if topic_id:
+        TOPIC_IDS[phone] = int(topic_id)
+
 async def get_or_create_topic(phone: str, user_name: str = "Unknown") -> int:
     """
-    Checks if a topic exists in DB. If not, creates one in the Admin Group.
+    Checks the cache, then the DB. If no topic exists, creates one in the Admin Group.
     Returns the topic_id (message_thread_id).
     """
+    cached = TOPIC_IDS.get(phone)
+    if cached:
+        return cached
+
     bot = get_bot()
     if not bot or not supabase:
         return 0
 
+    lock = _topic_locks.setdefault(phone, asyncio.Lock())
+    async with lock:
+        # Another task may have resolved it while we waited
+        cached = TOPIC_IDS.get(phone)
+        if cached:
+            return cached
+
+        try:
+            topic_id = await _fetch_or_create_topic(bot, phone, user_name)
+            if topic_id:
+                TOPIC_IDS[phone] = topic_id
+            return topic_id
+        finally:
+            # Failed creations must not leave their Lock behind either
+            _topic_locks.pop(phone, None)
+
+async def _fetch_or_create_topic(bot: Bot, phone: str, user_name: str) -> int:
     try:
         # 1. Check DB
         res = await supabase.table("users").select("telegram_topic_id").eq("phone", phone).maybe_single().execute()
@@ -110,39 +145,47 @@ async def get_or_create_topic(phone: str, user_name: str = "Unknown") -> int:
         except:
             pass # Non-critical
 
-        # 4. Save to DB
-        user_data = {
-            "phone": phone,
-            "name": user_name,
-            "telegram_topic_id": topic_id,
-            "status": "bot", # Default
-            "last_active_at": "now()"
-        }
-        await supabase.table("users").upsert(user_data).execute()
+        # 4. Save to DB: only the topic column. This can run in the background
+        # while bot.py routes/flushes the same user, so it must not rewrite
+        # name/status with the values it was started with.
+        res = await supabase.table("users").update({"telegram_topic_id": topic_id}).eq("phone", phone).execute()
+        if not (res and res.data):
+            # /new outreach to a phone the bot never saw: create the row
+            # (ignored if touch_user created it meanwhile), then link the topic
+            user_data = {
+                "phone": phone,
+                "name": user_name,
+                "status": "bot", # Default
+                "last_active_at": "now()"
+            }
+            await supabase.table("users").upsert(user_data, on_conflict="phone", ignore_duplicates=True).execute()
+            await supabase.table("users").update({"telegram_topic_id": topic_id}).eq("phone", phone).execute()
 
-        
         return topic_id
 
     except Exception as e:
         print(f"[Telegram Error] get_or_create_topic: {e}")
         return 0
 
-async def update_topic_title(phone: str, new_status: str, user_type: str):
+async def update_topic_title(phone: str, new_status: str, user_type: str, user: Optional[dict] = None):
     """
     Updates the topic title based on status and user type.
+    Pass the users row (e.g. returned by the status UPDATE) to skip re-reading it.
     """
     bot = get_bot()
     if not bot or not supabase:
         return
 
     try:
-        # Get topic_id and name from DB
-        res = await supabase.table("users").select("telegram_topic_id, name").eq("phone", phone).maybe_single().execute()
-        if not res or not res.data:
+        if user is None:
+            # Get topic_id and name from DB
+            res = await supabase.table("users").select("telegram_topic_id, name").eq("phone", phone).maybe_single().execute()
+            user = res.data if res else None
+        if not user:
             return
 
-        topic_id = res.data.get("telegram_topic_id")
-        user_name = res.data.get("name") or phone
+        topic_id = user.get("telegram_topic_id")
+        user_name = user.get("name") or phone
         
         if not topic_id:
             return
@@ -218,12 +261,25 @@ async def send_log_to_admin(phone: str, text: str, priority: str = 'log'):
             except:
                 pass
 
-        await bot.send_message(
-            chat_id=ADMIN_GROUP_ID,
-            message_thread_id=topic_id,
-            text=final_text,
-            disable_notification=disable_notif
-        )
+        try:
+            await bot.send_message(
+                chat_id=ADMIN_GROUP_ID,
+                message_thread_id=topic_id,
+                text=final_text,
+                disable_notification=disable_notif
+            )
+        except TelegramBadRequest as e:
+            if "can't parse entities" not in str(e):
+                raise
+            # User text with an unbalanced _ * ` breaks Markdown: resend it plain
+            # rather than lose the message (or a whole batch of mirrors).
+            await bot.send_message(
+                chat_id=ADMIN_GROUP_ID,
+                message_thread_id=topic_id,
+                text=final_text,
+                disable_notification=disable_notif,
+                parse_mode=None
+            )
 
     except Exception as e:
         print(f"[Telegram Log Error] {e}")
@@ -278,15 +334,14 @@ async def handle_admin_reply(message: Message):
 
         phone = user['phone']
         current_status = user.get('status', 'bot')
+        remember_topic(phone, topic_id)
 
         # Send to WhatsApp
         if current_status != 'human':
              await supabase.table("users").update({"status": "human"}).eq("phone", phone).execute()
              
-             # Create task to update title (non-blocking ideally, but await here is fine)
-             # Assumption: user_type unknown if not in DB, but we pass unknown. 
-             # In a real app we might fetch 'user_type' from 'user' dict if exists.
-             await update_topic_title(phone, "human", "unknown") 
+             # Title: reuse the row we already fetched (topic id, name, user_type)
+             await update_topic_title(phone, "human", user.get('user_type') or "unknown", user=user)
 
         # Try to send as interactive button message (cleanest UX)
         try:
@@ -307,14 +362,16 @@ async def on_resolve_click(callback: CallbackQuery):
     Handler for [✅ Volver a Bot] button in Telegram.
     """
     try:
-        phone = callback.data.split("_")[1]
+        phone = callback.data.removeprefix("resolve_")
         
         # Update DB
+        user = None
         if supabase:
-            await supabase.table("users").update({"status": "bot"}).eq("phone", phone).execute()
+            res = await supabase.table("users").update({"status": "bot"}).eq("phone", phone).execute()
+            user = res.data[0] if res and res.data else None
         
-        # Update Title
-        await update_topic_title(phone, "bot", "unknown")
+        # Update Title (UPDATE returned the row: no second read)
+        await update_topic_title(phone, "bot", (user or {}).get('user_type') or "unknown", user=user)
 
         await callback.message.edit_text(f"✅ Conversación marcada como resuelta (Bot).")
         await callback.answer()
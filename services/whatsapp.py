@@ -1,11 +1,46 @@
 import os
 import httpx
-from typing import List, Dict
+from functools import lru_cache
+import orjson
+from typing import List, Dict, Sequence, Optional
 
 # Environment Variables
 META_TOKEN = os.environ.get("META_TOKEN")
 PHONE_NUMBER_ID = os.environ.get("PHONE_NUMBER_ID")
 
+# Graph API endpoint and headers only depend on env: built once, reused by every send
+GRAPH_MESSAGES_URL = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
+GRAPH_HEADERS = {"Authorization": f"Bearer {META_TOKEN}", "Content-Type": "application/json"}
+
+# Shared HTTP client: keeps TLS connections to the Graph API alive between sends.
+# bot.py and worker_telegram.py hand it to Supabase too, so PostgREST calls use
+# the same pool; HTTP/2 multiplexes concurrent requests per host over one connection.
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the process-wide AsyncClient, creating it on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+            timeout=10.0
+        )
+    return _http_client
+
+async def close_http_client():
+    """Closes the shared client (call on shutdown)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# "+" and spaces dropped from phone numbers in one translate pass
+PHONE_STRIP_TABLE = str.maketrans('', '', '+ ')
+
+@lru_cache(maxsize=4096)
 def sanitize_argentina_number(phone_number: str) -> str:
     """
     Sanitizes Argentina Text/Sandbox numbers to the LOCAL format required by this specific Meta account.
@@ -17,7 +52,7 @@ def sanitize_argentina_number(phone_number: str) -> str:
     2. Insert '15' after '11' if missing.
     """
     # 0. Clean basic junk
-    phone = phone_number.strip().replace("+", "").replace(" ", "")
+    phone = phone_number.strip().translate(PHONE_STRIP_TABLE)
 
     # 1. Check if Argentina (54)
     if phone.startswith("54"):
@@ -48,8 +83,6 @@ async def send_whatsapp_message(to_number: str, text: str):
 
     normalized_to = sanitize_argentina_number(to_number)
     
-    url = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {META_TOKEN}", "Content-Type": "application/json"}
     payload = {
         "messaging_product": "whatsapp",
         "to": normalized_to,
@@ -58,9 +91,8 @@ async def send_whatsapp_message(to_number: str, text: str):
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json=payload, headers=headers)
-            resp.raise_for_status()
+        resp = await get_http_client().post(GRAPH_MESSAGES_URL, content=orjson.dumps(payload), headers=GRAPH_HEADERS)
+        resp.raise_for_status()
     except httpx.HTTPError as e:
         print(f"Error sending Text to {normalized_to}: {e}")
 
@@ -72,8 +104,6 @@ async def send_interactive_list(to_number: str, body_text: str, button_text: str
         return
 
     normalized_to = sanitize_argentina_number(to_number)
-    url = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {META_TOKEN}", "Content-Type": "application/json"}
     
     payload = {
         "messaging_product": "whatsapp",
@@ -95,13 +125,12 @@ async def send_interactive_list(to_number: str, body_text: str, button_text: str
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json=payload, headers=headers)
-            resp.raise_for_status()
+        resp = await get_http_client().post(GRAPH_MESSAGES_URL, content=orjson.dumps(payload), headers=GRAPH_HEADERS)
+        resp.raise_for_status()
     except httpx.HTTPError as e:
         print(f"Error sending List to {normalized_to}: {e}")
 
-async def send_interactive_buttons(to_number: str, body_text: str, buttons: List[Dict]):
+async def send_interactive_buttons(to_number: str, body_text: str, buttons: Sequence[Dict]):
     """
     Sends an Interactive Button Message.
     """
@@ -109,8 +138,6 @@ async def send_interactive_buttons(to_number: str, body_text: str, buttons: List
         return
 
     normalized_to = sanitize_argentina_number(to_number)
-    url = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {META_TOKEN}", "Content-Type": "application/json"}
     
     formatted_buttons = []
     for btn in buttons[:3]:
@@ -136,8 +163,7 @@ async def send_interactive_buttons(to_number: str, body_text: str, buttons: List
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json=payload, headers=headers)
-            resp.raise_for_status()
+        resp = await get_http_client().post(GRAPH_MESSAGES_URL, content=orjson.dumps(payload), headers=GRAPH_HEADERS)
+        resp.raise_for_status()
     except httpx.HTTPError as e:
         print(f"Error sending Buttons to {normalized_to}: {e}")
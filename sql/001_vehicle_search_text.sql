@@ -0,0 +1,33 @@
+-- Vehicle search: one lowercased, unaccented text column + trigram GIN index.
+-- bot.search_vehicle filters this column once per token instead of OR-ing
+-- an imatch regex across 8 columns (seq scan on every search).
+--
+-- Supabase installs extensions in the "extensions" schema.
+
+CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA extensions;
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA extensions;
+
+-- unaccent() is only STABLE; generated columns and indexes require IMMUTABLE.
+CREATE OR REPLACE FUNCTION public.f_unaccent(text)
+RETURNS text
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+AS $$ SELECT extensions.unaccent('extensions.unaccent'::regdictionary, $1) $$;
+
+ALTER TABLE public.vehicle
+    ADD COLUMN IF NOT EXISTS search_text text
+    GENERATED ALWAYS AS (
+        lower(public.f_unaccent(
+            coalesce(brand_car, '') || ' ' ||
+            coalesce(model, '') || ' ' ||
+            coalesce(series_suffix, '') || ' ' ||
+            coalesce(engine_code, '') || ' ' ||
+            coalesce(engine_series, '') || ' ' ||
+            coalesce(body_type, '') || ' ' ||
+            coalesce(fuel_type, '') || ' ' ||
+            coalesce(engine_valves::text, '')
+        ))
+    ) STORED;
+
+-- Serves both ILIKE '%tok%' and ~* regex filters on search_text
+CREATE INDEX IF NOT EXISTS vehicle_search_text_trgm
+    ON public.vehicle USING gin (search_text extensions.gin_trgm_ops);
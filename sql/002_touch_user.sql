@@ -0,0 +1,47 @@
+-- touch_user: one round trip per inbound message instead of SELECT + INSERT/UPDATE.
+-- Creates the user on first contact, bumps last_active_at, and resets an idle
+-- human session (> 60 min) back to the bot, all under the row lock.
+--
+-- Returns the users row as JSON plus two flags:
+--   was_new          -> row was created by this call (bot creates the Telegram topic)
+--   session_expired  -> human mode timed out (bot logs it to the admin topic)
+
+CREATE OR REPLACE FUNCTION public.touch_user(p_phone text, p_name text)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user public.users;
+    v_was_new boolean := false;
+    v_expired boolean := false;
+BEGIN
+    SELECT * INTO v_user FROM public.users WHERE phone = p_phone FOR UPDATE;
+
+    IF NOT FOUND THEN
+        INSERT INTO public.users (phone, name, status, user_type, last_active_at)
+        VALUES (p_phone, p_name, 'bot', 'unknown', now())
+        ON CONFLICT DO NOTHING
+        RETURNING * INTO v_user;
+        v_was_new := FOUND;
+
+        -- Lost a race with a concurrent first message: lock the winner's row
+        IF NOT v_was_new THEN
+            SELECT * INTO v_user FROM public.users WHERE phone = p_phone FOR UPDATE;
+        END IF;
+    END IF;
+
+    IF NOT v_was_new THEN
+        v_expired := v_user.status = 'human'
+            AND v_user.last_active_at < now() - interval '60 minutes';
+
+        UPDATE public.users
+           SET last_active_at = now(),
+               status = CASE WHEN v_expired THEN 'bot' ELSE status END
+         WHERE phone = p_phone
+        RETURNING * INTO v_user;
+    END IF;
+
+    RETURN to_jsonb(v_user)
+        || jsonb_build_object('was_new', v_was_new, 'session_expired', v_expired);
+END;
+$$;
@@ -0,0 +1,25 @@
+-- Vehicle search, whole-word lookups: tsvector twin of vehicle.search_text.
+-- Short tokens ("ka", "c3", "208") must match a whole word, which the trigram
+-- index can't serve (too few trigrams; \y regex falls back to a scan).
+-- bot.search_vehicle sends those through plfts(simple) on this column instead.
+--
+-- Generated columns can't reference each other, so the search_text expression
+-- from 001 is repeated. 'simple' = no stemming / stop words (model names).
+
+ALTER TABLE public.vehicle
+    ADD COLUMN IF NOT EXISTS search_doc tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('simple'::regconfig, lower(public.f_unaccent(
+            coalesce(brand_car, '') || ' ' ||
+            coalesce(model, '') || ' ' ||
+            coalesce(series_suffix, '') || ' ' ||
+            coalesce(engine_code, '') || ' ' ||
+            coalesce(engine_series, '') || ' ' ||
+            coalesce(body_type, '') || ' ' ||
+            coalesce(fuel_type, '') || ' ' ||
+            coalesce(engine_valves::text, '')
+        )))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS vehicle_search_doc_gin
+    ON public.vehicle USING gin (search_doc);
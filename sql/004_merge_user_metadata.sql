@@ -0,0 +1,16 @@
+-- merge_user_metadata: shallow-merge a patch into users.metadata in one
+-- atomic UPDATE (replaces bot.update_user_metadata's SELECT + UPDATE, which
+-- could lose keys when two answers landed concurrently).
+-- Anything that isn't a JSON object (NULL, legacy strings) starts from '{}'.
+
+CREATE OR REPLACE FUNCTION public.merge_user_metadata(p_phone text, p_patch jsonb)
+RETURNS void
+LANGUAGE sql
+AS $$
+    UPDATE public.users
+       SET metadata = CASE
+                          WHEN jsonb_typeof(metadata::jsonb) = 'object' THEN metadata::jsonb
+                          ELSE '{}'::jsonb
+                      END || p_patch
+     WHERE phone = p_phone;
+$$;
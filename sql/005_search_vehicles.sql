@@ -0,0 +1,32 @@
+-- search_vehicles: the whole vehicle search in one RPC (bot.search_vehicle).
+-- Same semantics as the previous PostgREST filter chain:
+--   year    -> in production range, or the year is part of the model name
+--   engine  -> exact displacement. p_engine is declared as
+--              vehicle.engine_disp_l%TYPE, so the parser's "1.6" / "2.0" is
+--              coerced to the column's own type and compared there, exactly
+--              like the old .eq("engine_disp_l", ...) (a float8 2.0 still
+--              matches "2.0"; a text column compares as text)
+--   p_long  -> every token is a substring of search_text   (trigram index, 001)
+--   p_short -> every word is a whole word of search_doc    (GIN tsvector, 003)
+-- Callers narrow the returned columns with PostgREST's ?select=.
+
+CREATE OR REPLACE FUNCTION public.search_vehicles(
+    p_long   text[]  DEFAULT '{}',
+    p_short  text    DEFAULT NULL,
+    p_year   int     DEFAULT NULL,
+    p_engine public.vehicle.engine_disp_l%TYPE DEFAULT NULL,
+    p_limit  int     DEFAULT 15
+)
+RETURNS SETOF public.vehicle
+LANGUAGE sql STABLE
+AS $$
+    SELECT v.*
+      FROM public.vehicle v
+     WHERE (p_year IS NULL
+            OR (v.year_from <= p_year AND (v.year_to >= p_year OR v.year_to IS NULL))
+            OR v.model ILIKE '%' || p_year || '%')
+       AND (p_engine IS NULL OR v.engine_disp_l = p_engine)
+       AND v.search_text ILIKE ALL (ARRAY(SELECT '%' || t || '%' FROM unnest(p_long) AS t))
+       AND (p_short IS NULL OR v.search_doc @@ plainto_tsquery('simple', p_short))
+     LIMIT p_limit;
+$$;
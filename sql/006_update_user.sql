@@ -0,0 +1,26 @@
+-- update_user: one UPDATE per message for users columns AND the metadata patch
+-- (bot.flush_user_fields). Replaces the separate merge_user_metadata call that
+-- every funnel step made before its column update.
+--
+-- p_fields: column values to set (only keys present are changed)
+-- p_meta:   shallow patch merged into metadata (non-objects start from '{}')
+-- Returns the updated row, like PATCH ... Prefer: return=representation.
+
+CREATE OR REPLACE FUNCTION public.update_user(p_phone text, p_fields jsonb, p_meta jsonb)
+RETURNS SETOF public.users
+LANGUAGE sql
+AS $$
+    UPDATE public.users AS u
+       SET (name, status, user_type, location, metadata) = (
+               SELECT r.name, r.status, r.user_type, r.location,
+                      CASE
+                          WHEN jsonb_typeof(u.metadata::jsonb) = 'object' THEN u.metadata::jsonb
+                          ELSE '{}'::jsonb
+                      END || coalesce(p_meta, '{}'::jsonb)
+                 FROM jsonb_populate_record(u, coalesce(p_fields, '{}'::jsonb)) AS r
+           )
+     WHERE u.phone = p_phone
+    RETURNING u.*;
+$$;
+
+DROP FUNCTION IF EXISTS public.merge_user_metadata(text, jsonb);
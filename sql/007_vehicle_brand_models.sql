@@ -0,0 +1,21 @@
+-- vehicle_brand_models: the brand -> models catalog in one small result set
+-- (one row per brand). bot.get_brand_models keeps it in memory so brand-only
+-- queries ("ford", "vw") get the model picker without running a search.
+-- vehicle_count lets the bot skip the picker for brands small enough (<= 10
+-- vehicles) to list directly, as the search did before.
+--
+-- brand_key matches the bot's folded query text (lower + unaccent, see 001).
+
+CREATE OR REPLACE FUNCTION public.vehicle_brand_models()
+RETURNS TABLE (brand_key text, brand_car text, models text[], vehicle_count int)
+LANGUAGE sql STABLE
+AS $$
+    SELECT lower(public.f_unaccent(v.brand_car::text)),
+           min(v.brand_car::text),
+           array_agg(DISTINCT v.model::text),
+           count(*)::int
+      FROM public.vehicle v
+     WHERE v.brand_car IS NOT NULL
+       AND v.model IS NOT NULL
+     GROUP BY 1;
+$$;
@@ -0,0 +1,34 @@
+-- search_vehicles_fuzzy: typo-tolerant fallback for bot.search_vehicle, used
+-- only when the exact search (005) returns nothing ("amarock", "corola").
+--   p_long  -> every token word-similar to search_text (pg_trgm %>, threshold
+--              pg_trgm.word_similarity_threshold), served by the trigram index (001)
+--   p_short -> every word is a whole word of search_doc, exactly as in 005:
+--              short tokens ("500", "ka") are never relaxed, so a miss on them
+--              stays a miss instead of returning any row of the brand
+--   year / engine -> same as search_vehicles (engine in the column's own type)
+-- Closest rows first (summed word-similarity distance).
+
+CREATE OR REPLACE FUNCTION public.search_vehicles_fuzzy(
+    p_long   text[],
+    p_short  text    DEFAULT NULL,
+    p_year   int     DEFAULT NULL,
+    p_engine public.vehicle.engine_disp_l%TYPE DEFAULT NULL,
+    p_limit  int     DEFAULT 15
+)
+RETURNS SETOF public.vehicle
+LANGUAGE sql STABLE
+SET search_path = public, extensions
+AS $$
+    SELECT v.*
+      FROM public.vehicle v
+     WHERE cardinality(p_long) > 0
+       AND v.search_text %> p_long[1]              -- index-backed candidate set
+       AND v.search_text %> ALL (p_long)
+       AND (p_short IS NULL OR v.search_doc @@ plainto_tsquery('simple', p_short))
+       AND (p_year IS NULL
+            OR (v.year_from <= p_year AND (v.year_to >= p_year OR v.year_to IS NULL))
+            OR v.model ILIKE '%' || p_year || '%')
+       AND (p_engine IS NULL OR v.engine_disp_l = p_engine)
+     ORDER BY (SELECT sum(t <<-> v.search_text) FROM unnest(p_long) AS t)
+     LIMIT p_limit;
+$$;
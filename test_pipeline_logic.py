@@ -0,0 +1,276 @@
+"""
+Message pipeline checks for bot.py (Telegram mirror batching, webhook dedup,
+button and survey-state dispatch,
+per-phone ordering, Telegram topic locks).
+No network: Telegram sends are captured in a list. Run with
+`python test_pipeline_logic.py` or `pytest test_pipeline_logic.py`.
+"""
+import asyncio
+import re
+
+import bot
+from services import telegram_crm
+
+
+def _capture_admin_logs():
+    """Replaces send_log_to_admin with a recorder of (phone, text, priority)."""
+    sent = []
+
+    async def fake_send(phone, text, priority='log'):
+        sent.append((phone, text, priority))
+
+    telegram_crm.send_log_to_admin = fake_send
+    return sent
+
+
+# --- Telegram mirror batching ---
+
+def test_flusher_coalesces_per_phone_in_order():
+    sent = _capture_admin_logs()
+
+    async def run():
+        bot.MIRROR_Q = asyncio.Queue()
+        flusher = asyncio.create_task(bot._mirror_flusher())
+        bot.queue_admin_log("A", "a1")
+        bot.queue_admin_log("B", "b1")
+        bot.queue_admin_log("A", "a2")
+        bot.queue_admin_log("B", "b2")
+        bot.queue_admin_log("A", "a3")
+        await asyncio.sleep(bot.MIRROR_WINDOW_S * 2)
+        flusher.cancel()
+
+    asyncio.run(run())
+    assert sent == [("A", "a1\n\na2\n\na3", "log"), ("B", "b1\n\nb2", "log")]
+
+
+def test_oversized_batch_splits_under_limit_in_order():
+    sent = _capture_admin_logs()
+    texts = [c * 1500 for c in "xyzw"]
+    asyncio.run(bot._send_mirror_batch({"A": texts, "B": ["short"]}))
+
+    assert [phone for phone, _, _ in sent] == ["A", "A", "B"]
+    assert all(len(text) <= bot.MIRROR_MAX_CHARS for _, text, _ in sent)
+    assert sent[0][1] == "\n\n".join(texts[:2])
+    assert sent[1][1] == "\n\n".join(texts[2:])
+    assert sent[2][1] == "short"
+
+
+def test_single_text_over_limit_is_sent_alone():
+    sent = _capture_admin_logs()
+    big = "x" * (bot.MIRROR_MAX_CHARS + 10)
+    asyncio.run(bot._send_mirror_batch({"A": ["before", big, "after"]}))
+    assert [text for _, text, _ in sent] == ["before", big, "after"]
+
+
+def test_drain_flushes_leftovers_on_shutdown():
+    sent = _capture_admin_logs()
+
+    async def run():
+        bot.MIRROR_Q = asyncio.Queue()
+        bot.queue_admin_log("A", "a1")
+        bot.queue_admin_log("B", "b1")
+        bot.queue_admin_log("A", "a2")
+        await bot._drain_mirror_queue()
+        assert bot.MIRROR_Q.empty()
+
+    asyncio.run(run())
+    assert sent == [("A", "a1\n\na2", "log"), ("B", "b1", "log")]
+
+
+# --- Processed-message dedup ---
+
+def test_seen_message_dedups_and_evicts_oldest():
+    bot.PROCESSED_MSG_IDS.clear()
+    bot.PROCESSED_MSG_SET.clear()
+    cap = bot.PROCESSED_MSG_IDS.maxlen
+
+    assert not bot.seen_message("m0")
+    assert bot.seen_message("m0")
+    for i in range(1, cap + 1):
+        assert not bot.seen_message(f"m{i}")
+
+    # m0 fell off the deque, so the set must have forgotten it too
+    assert len(bot.PROCESSED_MSG_SET) == len(bot.PROCESSED_MSG_IDS) == cap
+    assert "m0" not in bot.PROCESSED_MSG_SET
+    assert bot.seen_message(f"m{cap}")
+    assert not bot.seen_message("m0")
+
+
+# --- Routing: button dispatch ---
+
+def _route(msg, status="bot"):
+    """
+    Runs route_message for one message with the WhatsApp side recorded.
+    Returns (pending, sends) where sends are (kind, text) tuples in call order.
+    """
+    sends = []
+
+    async def fake_reply(phone, text, buttons=None, list_rows=None, list_title=None):
+        sends.append(("reply", text))
+
+    async def fake_whatsapp(phone, text):
+        sends.append(("whatsapp", text))
+
+    async def fake_car_actions(phone, vehicle_id):
+        sends.append(("car_actions", vehicle_id))
+
+    async def no_log(*args, **kwargs):
+        pass
+
+    bot.reply_and_mirror = fake_reply
+    bot.send_whatsapp_message = fake_whatsapp
+    bot.send_car_actions = fake_car_actions
+    bot.log_user_event = no_log
+    _capture_admin_logs()
+    pending = {}
+
+    async def run():
+        bot.MIRROR_Q = asyncio.Queue()
+        await bot.route_message("549", msg, msg["type"], {"status": status}, pending)
+
+    asyncio.run(run())
+    return pending, sends
+
+
+def _button(btn_id, title="x"):
+    return {"type": "interactive", "interactive": {"type": "button_reply", "button_reply": {"id": btn_id, "title": title}}}
+
+
+def test_button_table_matches_id_regex():
+    actions = re.search(r"\(\?P<action>([^)]*)\)", bot.BTN_ID_RE.pattern).group(1).split("|")
+    assert set(actions) == set(bot.BUTTON_HANDLERS)
+
+
+def test_button_with_vehicle_arg():
+    pending, sends = _route(_button("btn_buy_loc_123"))
+    assert pending == {"status": "waiting_buyer_location"}
+    assert sends == [("reply", "📍 ¿De qué Barrio o Ciudad sos?")]
+
+    pending, sends = _route(_button("btn_back_actions_42"))
+    assert pending == {}
+    assert sends == [("car_actions", "42")]
+
+
+def test_button_alias_and_unknown():
+    # search_error shares the search_retry handler
+    pending, sends = _route(_button("btn_search_error"))
+    assert pending == {"status": "bot"}
+    assert sends == [("whatsapp", bot.SHORT_WELCOME)]
+
+    pending, sends = _route(_button("btn_no_such_action"))
+    assert pending == {} and sends == []
+
+
+# --- Routing: survey state dispatch ---
+
+def _text(body):
+    return {"type": "text", "text": {"body": body}}
+
+
+def test_state_handler_advances_survey():
+    pending, sends = _route(_text("San  Martín\n"), status="waiting_buyer_location")
+    assert pending == {
+        "location": "San Martín",
+        "status": "waiting_buyer_urgency",
+        "metadata": {"location": "San Martín"},
+    }
+    assert len(sends) == 1 and sends[0][1].startswith("⏳")
+
+    pending, _ = _route(_text("Repuestos Juan"), status="waiting_seller_name")
+    assert pending == {
+        "status": "waiting_seller_location",
+        "name": "Repuestos Juan",
+        "metadata": {"shop_name": "Repuestos Juan"},
+    }
+
+
+def test_cancel_wins_over_state_handler():
+    pending, sends = _route(_text("cancelar"), status="waiting_seller_name")
+    assert pending == {"status": "bot"}
+    assert sends == [("reply", bot.SHORT_WELCOME)]
+
+
+def test_state_handler_skipped_without_input():
+    pending, sends = _route({"type": "image"}, status="waiting_buyer_location")
+    assert pending == {} and sends == []
+
+
+def test_menu_mode_feedback_queues_status():
+    writes = []
+
+    async def fake_update(phone, fields):
+        writes.append(fields)
+
+    bot.update_user_fields = fake_update
+    bot.supabase = None  # no catalog: the feedback text finds no vehicle
+    pending, sends = _route(_text("el filtro de aire no coincide"), status="menu_mode")
+    assert pending == {"status": "bot"}
+    assert writes == []  # written once by process_message, not mid-routing
+    assert sends == [("reply", "✅ Gracias. Mensaje recibido, lo revisaremos.")]
+
+
+# --- Per-phone ordering ---
+
+def test_process_in_order_serializes_per_phone_and_drops_locks():
+    events = []
+
+    async def fake_process(value, msg):
+        events.append(("start", msg["from"], msg["id"]))
+        await asyncio.sleep(0.01)
+        events.append(("end", msg["from"], msg["id"]))
+        if msg["id"] == "a2":
+            raise RuntimeError("handler failed")
+
+    bot.process_message = fake_process
+
+    async def run():
+        msgs = [{"from": "A", "id": "a1"}, {"from": "B", "id": "b1"},
+                {"from": "A", "id": "a2"}, {"from": "A", "id": "a3"}]
+        results = await asyncio.gather(*(bot.process_in_order({}, m) for m in msgs), return_exceptions=True)
+        assert isinstance(results[2], RuntimeError)
+
+    asyncio.run(run())
+
+    # Phone A never overlaps itself and keeps arrival order; B runs alongside
+    a_events = [(kind, mid) for kind, phone, mid in events if phone == "A"]
+    assert a_events == [("start", "a1"), ("end", "a1"), ("start", "a2"), ("end", "a2"), ("start", "a3"), ("end", "a3")]
+    assert events.index(("start", "B", "b1")) < events.index(("end", "A", "a1"))
+
+    # Idle phones leave nothing behind, even after a failed message
+    assert bot.PHONE_LOCKS == {}
+    assert dict(bot.PHONE_INFLIGHT) == {}
+
+
+# --- Telegram topic creation ---
+
+def test_topic_lock_dropped_on_success_and_failure():
+    results = {"ok": 77, "fail": 0}
+
+    async def fake_fetch_or_create(tg_bot, phone, user_name):
+        if phone == "boom":
+            raise RuntimeError("create_forum_topic failed")
+        return results[phone]
+
+    get_bot, supabase, fetch = telegram_crm.get_bot, telegram_crm.supabase, telegram_crm._fetch_or_create_topic
+    telegram_crm.get_bot = lambda: object()
+    telegram_crm.supabase = object()
+    telegram_crm._fetch_or_create_topic = fake_fetch_or_create
+    try:
+        assert asyncio.run(telegram_crm.get_or_create_topic("ok")) == 77
+        assert asyncio.run(telegram_crm.get_or_create_topic("fail")) == 0
+        try:
+            asyncio.run(telegram_crm.get_or_create_topic("boom"))
+        except RuntimeError:
+            pass
+    finally:
+        telegram_crm.get_bot, telegram_crm.supabase, telegram_crm._fetch_or_create_topic = get_bot, supabase, fetch
+        telegram_crm.TOPIC_IDS.pop("ok", None)
+
+    assert telegram_crm._topic_locks == {}
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,240 @@
+"""
+Search path checks for bot.py (parser, search_vehicle RPC params, brand index).
+No network: Supabase is replaced by a recorder. Run with `python test_search_logic.py`
+or `pytest test_search_logic.py`.
+"""
+import asyncio
+
+import bot
+
+
+class _Res:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Rpc:
+    def __init__(self, fake, name, params):
+        self.fake, self.name, self.params = fake, name, params
+
+    def select(self, *cols):
+        return self
+
+    async def execute(self):
+        self.fake.calls.append((self.name, self.params))
+        return _Res(self.fake.respond(self.name, self.params))
+
+
+class _FakeSupabase:
+    """Records rpc(name, params); `respond` decides the rows (default: none)."""
+    def __init__(self, respond=None):
+        self.calls = []
+        self.respond = respond or (lambda name, params: [])
+
+    def rpc(self, name, params):
+        return _Rpc(self, name, params)
+
+
+FIAT_PALIO = {
+    "vehicle_id": 1, "brand_car": "Fiat", "model": "Palio", "series_suffix": None,
+    "body_type": None, "fuel_type": "Nafta", "year_from": 2010, "year_to": None,
+    "engine_disp_l": "1.4", "power_hp": 85, "engine_valves": 8,
+}
+
+
+def _catalog_fiat_palio(name, params):
+    """
+    Stand-in for the two search RPCs over a catalog holding only a Fiat Palio:
+    search_vehicles misses "fiat 500"; search_vehicles_fuzzy matches "fiat"
+    but applies the whole-word p_short filter, and "500" is not a word of it.
+    """
+    if name == "search_vehicles_fuzzy" and params.get("p_short") in (None, "palio"):
+        return [FIAT_PALIO]
+    return []
+
+
+def _search(text):
+    fake = _FakeSupabase()
+    bot.supabase = fake
+    bot.SEARCH_CACHE.clear()
+    asyncio.run(bot.search_vehicle(bot.parse_search_query(text), limit=15))
+    return fake.calls
+
+
+# --- Parser: engine path ---
+
+def test_engine_filter_is_text_displacement():
+    # Always "N.N": search_vehicles coerces it to engine_disp_l's own type
+    assert bot.parse_search_query("Gol 1.6")["engine_filter"] == "1.6"
+    assert bot.parse_search_query("gol 1,6")["engine_filter"] == "1.6"
+    assert bot.parse_search_query("amarok 2l")["engine_filter"] == "2.0"
+    assert bot.parse_search_query("206 2.0")["engine_filter"] == "2.0"
+
+
+def test_engine_and_year_together():
+    q = bot.parse_search_query("Toyota Hilux 3.0 2010")
+    assert q == {"text_tokens": ["toyota", "hilux"], "year_filter": 2010, "engine_filter": "3.0"}
+
+
+def test_engine_token_not_confused_with_valves():
+    q = bot.parse_search_query("gol 1.6 16v")
+    assert q["engine_filter"] == "1.6"
+    assert q["text_tokens"] == ["gol", "16v"]
+
+
+def _parsed(text):
+    q = bot.parse_search_query(text)
+    return q["text_tokens"], q["year_filter"], q["engine_filter"]
+
+
+# --- Parser: synonyms, stop words, numeric models, ranges ---
+
+def test_synonym_comma_decimal_and_year():
+    assert _parsed("vw gol 1,6 2010") == (["volkswagen", "gol"], 2010, "1.6")
+
+
+def test_s10_spans_token_boundary():
+    assert _parsed("s 10") == (["s10"], None, None)
+    assert _parsed("S-10 2.8") == (["s10"], None, "2.8")
+
+
+def test_numeric_models_stay_text():
+    # Whitelisted model, and a non-whitelisted one too big to be a displacement
+    assert _parsed("Peugeot 208") == (["peugeot", "208"], None, None)
+    assert _parsed("fiat 147") == (["fiat", "147"], None, None)
+
+
+def test_accented_brand():
+    assert _parsed("Citroën C4") == (["citroën", "c4"], None, None)
+    assert _parsed("citroen c4") == (["citroën", "c4"], None, None)
+
+
+def test_stop_words_only():
+    assert _parsed("quiero un filtro") == ([], None, None)
+
+
+def test_year_out_of_range_is_text():
+    assert _parsed("gol 1940") == (["gol", "1940"], None, None)
+    assert _parsed("gol 2031") == (["gol", "2031"], None, None)
+
+
+def test_fold_accents_matches_unaccent():
+    # Decomposable accents, plus letters f_unaccent folds that NFKD leaves alone
+    assert bot.fold_accents("Citroën Mégane Škoda") == "citroen megane skoda"
+    assert bot.fold_accents("Ø Æ Œ Straße Łada Þór") == "o ae oe strasse lada thor"
+    assert bot.fold_accents("Nguyễn") == "nguyen"
+
+
+def test_engine_filter_sent_to_rpc_as_string():
+    name, params = _search("gol 1.6")[0]
+    assert name == "search_vehicles"
+    assert params["p_engine"] == "1.6"
+
+
+# --- Fuzzy fallback keeps short tokens ---
+
+def test_fuzzy_fallback_forwards_short_tokens():
+    fake = _FakeSupabase(_catalog_fiat_palio)
+    bot.supabase = fake
+    bot.SEARCH_CACHE.clear()
+    rows = asyncio.run(bot.search_vehicle(bot.parse_search_query("fiat 500"), limit=15))
+    assert rows == []
+    assert [name for name, _ in fake.calls] == ["search_vehicles", "search_vehicles_fuzzy"]
+    assert fake.calls[1][1]["p_long"] == ["fiat"]
+    assert fake.calls[1][1]["p_short"] == "500"
+
+
+def test_short_token_miss_replies_not_found():
+    fake = _FakeSupabase(_catalog_fiat_palio)
+    bot.supabase = fake
+    bot.SEARCH_CACHE.clear()
+    bot.BRAND_MODELS_LOADED_AT = float("inf")  # brand index not under test
+    replies = []
+
+    async def capture(phone, text, **kwargs):
+        replies.append(text)
+
+    async def no_log(*args, **kwargs):
+        pass
+
+    orig_reply, orig_log = bot.reply_and_mirror, bot.log_user_event
+    bot.reply_and_mirror, bot.log_user_event = capture, no_log
+    try:
+        asyncio.run(bot.process_search_request("5491100000000", "fiat 500", "bot", {}))
+    finally:
+        bot.reply_and_mirror, bot.log_user_event = orig_reply, orig_log
+        bot.BRAND_MODELS_LOADED_AT = float("-inf")
+
+    assert len(replies) == 1
+    assert replies[0].startswith("🤔 No encontré 'fiat 500'")
+
+
+# --- Brand-only queries: in-memory model index ---
+
+def _brand_search(text, index, respond=None):
+    """Runs process_search_request with BRAND_MODELS preloaded; returns (replies, rpc names)."""
+    fake = _FakeSupabase(respond)
+    bot.supabase = fake
+    bot.SEARCH_CACHE.clear()
+    bot.BRAND_MODELS = index
+    bot.BRAND_MODELS_LOADED_AT = float("inf")  # fresh: no reload
+    replies = []
+
+    async def capture(phone, text, **kwargs):
+        replies.append((text, kwargs))
+
+    async def no_log(*args, **kwargs):
+        pass
+
+    orig_reply, orig_log = bot.reply_and_mirror, bot.log_user_event
+    bot.reply_and_mirror, bot.log_user_event = capture, no_log
+    try:
+        asyncio.run(bot.process_search_request("5491100000000", text, "bot", {}))
+    finally:
+        bot.reply_and_mirror, bot.log_user_event = orig_reply, orig_log
+        bot.BRAND_MODELS, bot.BRAND_MODELS_LOADED_AT = {}, float("-inf")
+    return replies, [name for name, _ in fake.calls]
+
+
+def test_big_brand_gets_model_picker_without_search():
+    index = {"fiat": ("Fiat", ("500", "Palio", "Uno"), 40)}
+    replies, rpcs = _brand_search("Fiat", index)
+    assert rpcs == []
+    assert replies[0][0] == "Encontré modelos de Fiat. Seleccioná uno:"
+    assert [r["title"] for r in replies[0][1]["list_rows"]] == ["500", "Palio", "Uno"]
+
+
+def test_small_brand_lists_vehicles_directly():
+    index = {"fiat": ("Fiat", ("Palio", "Uno"), 2)}
+    replies, rpcs = _brand_search("fiat", index, lambda name, params: [FIAT_PALIO])
+    assert rpcs == ["search_vehicles"]
+    assert replies[0][0] == "Encontré 1 opciones. Seleccioná motor:"
+
+
+def test_stale_brand_index_served_while_reloading():
+    fake = _FakeSupabase(lambda name, params: [
+        {"brand_key": "fiat", "brand_car": "Fiat", "models": ["Uno", "Palio"], "vehicle_count": 30},
+    ])
+    bot.supabase = fake
+    bot.BRAND_MODELS = {"fiat": ("Fiat", ("Palio",), 12)}
+    bot.BRAND_MODELS_LOADED_AT = float("-inf")
+
+    async def run():
+        # The stale entry is returned at once; the reload runs in the background
+        assert bot.get_brand_models("fiat") == ("Fiat", ("Palio",), 12)
+        assert fake.calls == []
+        await asyncio.gather(*bot.BACKGROUND_TASKS)
+
+    try:
+        asyncio.run(run())
+        assert fake.calls == [("vehicle_brand_models", {})]
+        assert bot.BRAND_MODELS == {"fiat": ("Fiat", ("Palio", "Uno"), 30)}
+    finally:
+        bot.BRAND_MODELS, bot.BRAND_MODELS_LOADED_AT = {}, float("-inf")
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"ok  {name}")
@@ -0,0 +1,43 @@
+import os
+import asyncio
+from supabase import AsyncClientOptions, create_async_client
+
+import services.telegram_crm as telegram_crm
+from services.whatsapp import get_http_client, close_http_client
+
+# Environment Variables
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+
+async def main():
+    """
+    Runs Telegram polling (admin replies, callbacks, /new) in its own process,
+    isolated from the FastAPI webhook loop in bot.py.
+    """
+    if SUPABASE_URL and SUPABASE_KEY:
+        telegram_crm.supabase = await create_async_client(
+            SUPABASE_URL, SUPABASE_KEY,
+            options=AsyncClientOptions(httpx_client=get_http_client())
+        )
+    else:
+        print("WARNING: Supabase credentials missing services will fail.")
+
+    bot, dp = await telegram_crm.start_telegram()
+    if not bot:
+        return
+
+    print("Starting Telegram Bot Polling...")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        print("Stopping Telegram Bot Polling...")
+        await bot.session.close()
+        await close_http_client()
+
+if __name__ == "__main__":
+    try:
+        import uvloop  # shipped with uvicorn[standard]
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(main())